@@ -0,0 +1,193 @@
+"""
+Runs a batch without Anki's GUI, straight on a collection file, e.g. from cron:
+
+    python -m <add-on folder> ~/.local/share/Anki2/User\ 1/collection.anki2 \\
+        --search "deck:Spanish" --workers 4
+
+Anki has to be closed while this runs, since it locks the collection. See
+--help for the rest of the options.
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Optional
+
+from anki.collection import Collection
+from .config_keys import ConfigKeys
+from .logging import logger
+from .pipeline import ProgressReporter, format_summary, open_journal, run_batch
+from .scheduler import RunProgress, format_progress
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class CommandLineReporter(ProgressReporter):
+    """
+    The run is cancelled once `cancel` is set, see `main`.
+    """
+
+    def __init__(self, cancel: threading.Event):
+        self._cancel = cancel
+
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+
+class TextReporter(CommandLineReporter):
+    """
+    Prints the progress for people, on stderr.
+    """
+    # Don't print the progress more often than this.
+    PRINT_INTERVAL_SEC = 1
+
+    def __init__(self, cancel: threading.Event):
+        super().__init__(cancel)
+        self._last_printed = 0
+
+    def message(self, label: str) -> None:
+        print(label, file=sys.stderr, flush=True)
+
+    def progress(self, progress: RunProgress) -> None:
+        now = time.monotonic()
+        if now - self._last_printed < TextReporter.PRINT_INTERVAL_SEC:
+            return
+        self._last_printed = now
+        print(format_progress(progress), file=sys.stderr, flush=True)
+
+
+class JsonReporter(CommandLineReporter):
+    """
+    Prints one JSON object per line on stdout, for other programs.
+    """
+
+    def __init__(self, cancel: threading.Event):
+        super().__init__(cancel)
+        self._lock = threading.Lock()
+        self._last_num_completed = -1
+
+    def emit(self, event: dict) -> None:
+        with self._lock:
+            print(json.dumps(event), flush=True)
+
+    def message(self, label: str) -> None:
+        self.emit({"event": "message", "message": label})
+
+    def progress(self, progress: RunProgress) -> None:
+        if progress.notes_completed != self._last_num_completed:
+            self._last_num_completed = progress.notes_completed
+            self.emit(dict(event="progress", **progress._asdict()))
+
+
+def load_config(path: Optional[str]):
+    """
+    Starts from the defaults in config.json, then applies either the given
+    config file or, without one, the config that was last saved from Anki.
+    """
+    with open(os.path.join(ADDON_DIR, "config.json")) as f:
+        config = json.load(f)
+    if path is not None:
+        with open(path) as f:
+            config.update(json.load(f))
+        return config
+    # This is where Anki keeps the config once it's been changed.
+    meta_path = os.path.join(ADDON_DIR, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            config.update(json.load(f).get("config", {}))
+    return config
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Batch download images for the notes in an Anki "
+                    "collection, without Anki's GUI.")
+    parser.add_argument("collection", help="path to the .anki2 file")
+    notes = parser.add_mutually_exclusive_group(required=True)
+    notes.add_argument("--search",
+                       help='Anki search for the notes, e.g. "deck:Spanish"')
+    notes.add_argument("--note-ids", help="comma separated note ids")
+    notes.add_argument("--resume", action="store_true",
+                       help="resume the last unfinished run (from Anki or "
+                            "from here) with the config it was started with")
+    parser.add_argument("--config",
+                        help="config JSON, in the same format as config.json. "
+                             "Defaults to the config saved from Anki")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes to shard the "
+                             "scraping across. 0 (the default) scrapes on "
+                             "threads in this process, like in Anki")
+    parser.add_argument("--bypass-cache", action="store_true",
+                        help="always search again instead of reusing results "
+                             "from earlier runs")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time the stages of the run and write a report "
+                             "and a Chrome trace, like the instrumentation "
+                             "config")
+    parser.add_argument("--json", action="store_true",
+                        help="print the progress and the summary as JSON "
+                             "lines on stdout")
+    args = parser.parse_args(argv)
+
+    # The first Ctrl-C cancels the run, keeping the notes that are done, the
+    # second one quits right away.
+    cancel = threading.Event()
+
+    def on_interrupt(signum, frame):
+        if cancel.is_set():
+            raise KeyboardInterrupt
+        cancel.set()
+        print("Cancelling, finishing the queries in flight (Ctrl-C again to "
+              "quit)...", file=sys.stderr, flush=True)
+
+    signal.signal(signal.SIGINT, on_interrupt)
+
+    if args.json:
+        # Keep stdout for the JSON.
+        for handler in logger.handlers:
+            handler.setStream(sys.stderr)
+        reporter = JsonReporter(cancel)
+    else:
+        reporter = TextReporter(cancel)
+
+    journal = open_journal()
+    if args.resume:
+        last_run = journal.resume()
+        if last_run is None:
+            journal.close()
+            print("There is no unfinished run to resume.", file=sys.stderr)
+            return 1
+        config, note_ids = last_run
+    else:
+        config = load_config(args.config)
+
+    col = Collection(args.collection)
+    try:
+        if args.search is not None:
+            note_ids = list(col.find_notes(args.search))
+        elif args.note_ids is not None:
+            note_ids = [int(note_id) for note_id in args.note_ids.split(",")]
+        if not args.resume:
+            journal.start(config, note_ids)
+        if args.instrument:
+            config[ConfigKeys.INSTRUMENTATION] = True
+        stats = run_batch(col, config, note_ids,
+                          bypass_cache=args.bypass_cache, journal=journal,
+                          reporter=reporter, num_workers=args.workers)
+    finally:
+        col.close()
+
+    if args.json:
+        reporter.emit(dict(event="summary", **stats))
+    else:
+        print(format_summary(stats))
+    # Same as when killed by Ctrl-C.
+    return 130 if stats["cancelled"] else 0
+
+
+# Worker processes import this module too, see pipeline.ShardedBackend.
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+A local stand-in for Bing Images, for benchmarking the pipeline offline.
+
+/images/async?q=... answers like Bing does, with a page of `murl` entries that
+point back at this server, and /img/... serves a corpus of generated images in
+a few sizes and formats. The images are spread over several hosts (127.0.0.2,
+127.0.0.3, ... where the OS has them, like Linux does), since the scraper caps
+its connections per host and Bing's results come from all over. Latency, 429s,
+hanging requests and SVGs can be mixed in. The faults are drawn from a seeded
+RNG, so the mix is the same from run to run (though not which request gets
+which, since that depends on timing).
+
+    python benchmarks/bing_stand_in.py --port 8000 --throttle-rate 0.1
+
+Needs Pillow. Doesn't need Anki.
+"""
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib.parse
+from typing import NamedTuple
+
+from PIL import Image, ImageDraw
+
+# Roughly what one Bing page has.
+RESULTS_PER_PAGE = 35
+# Filler between the results, so that the page is about as big as Bing's.
+FILLER_BYTES_PER_RESULT = 4000
+
+SVG = (b'<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100">'
+       b'<rect width="100" height="100"/></svg>')
+
+
+class Faults(NamedTuple):
+    # Added before every response.
+    latency_sec: float = 0.0
+    # Fraction of searches answered with a 429.
+    throttle_rate: float = 0.0
+    # Fraction of image requests that hang for `hang_sec` and then close
+    # without an answer.
+    timeout_rate: float = 0.0
+    hang_sec: float = 5.0
+    # Fraction of image requests answered with an SVG.
+    svg_rate: float = 0.0
+
+
+def make_corpus(seed: int, num_images: int = 48):
+    """
+    Distinct images (random shapes, so that they don't look alike to the
+    near-duplicate filter) of the sizes and formats that Bing tends to return.
+    Returns a list of (content type, data).
+    """
+    rng = random.Random(seed)
+    kinds = [("JPEG", "image/jpeg", (1600, 1200)),
+             ("JPEG", "image/jpeg", (640, 480)),
+             ("JPEG", "image/jpeg", (3000, 2000)),
+             ("PNG", "image/png", (800, 600)),
+             ("WEBP", "image/webp", (1024, 768)),
+             ("GIF", "image/gif", (400, 300))]
+    corpus = []
+    for i in range(num_images):
+        image_format, content_type, size = kinds[i % len(kinds)]
+        im = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(im)
+        for _ in range(12):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            w, h = rng.randrange(size[0] // 2), rng.randrange(size[1] // 2)
+            draw.ellipse((x, y, x + w, y + h),
+                         fill=tuple(rng.randrange(256) for _ in range(3)))
+        buf = io.BytesIO()
+        im.save(buf, format=image_format)
+        corpus.append((content_type, buf.getvalue()))
+    return corpus
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/stats":
+            with server.lock:
+                self._send(200, "application/json",
+                           json.dumps(server.counters).encode())
+            return
+        if server.faults.latency_sec:
+            time.sleep(server.faults.latency_sec)
+        if url.path == "/images/async":
+            self._search(urllib.parse.parse_qs(url.query).get("q", [""])[0])
+        elif url.path.startswith("/img/"):
+            self._image(url.path[len("/img/"):])
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def _search(self, query: str):
+        server = self.server
+        if server.roll("searches", server.faults.throttle_rate, "throttled"):
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        # Same query, same results.
+        rng = random.Random(hashlib.sha1(query.encode()).digest())
+        indexes = rng.sample(range(len(server.corpus)),
+                             min(RESULTS_PER_PAGE, len(server.corpus)))
+        parts = []
+        for n, index in enumerate(indexes):
+            # The same image is always on the same host.
+            host = server.image_hosts[index % len(server.image_hosts)]
+            image_url = "http://%s/img/%d/%s-%d" % (
+                host, index, urllib.parse.quote(query, safe=""), n)
+            parts.append('<a class="iusc" m="{&quot;murl&quot;:&quot;%s&quot;}">'
+                         % image_url)
+            parts.append("x" * FILLER_BYTES_PER_RESULT)
+        self._send(200, "text/html", "".join(parts).encode())
+
+    def _image(self, name: str):
+        server = self.server
+        if server.roll("images", server.faults.timeout_rate, "hung"):
+            time.sleep(server.faults.hang_sec)
+            self.close_connection = True
+            return
+        if server.roll(None, server.faults.svg_rate, "svgs"):
+            self._send(200, "image/svg+xml", SVG)
+            return
+        index, _, unique = name.partition("/")
+        content_type, data = server.corpus[int(index) % len(server.corpus)]
+        # Trailing bytes are ignored by the decoders, but make every URL's
+        # image different, so that no two results are written as one media
+        # file.
+        self._send(200, content_type, data + unique.encode())
+        with server.lock:
+            server.counters["image_bytes"] += len(data)
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, faults: Faults, seed: int):
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.faults = faults
+        self.corpus = make_corpus(seed)
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.counters = {"searches": 0, "images": 0, "throttled": 0,
+                         "hung": 0, "svgs": 0, "image_bytes": 0}
+        # "host:port" of every address the images are served from.
+        self.image_hosts = ["%s:%d" % self.server_address]
+
+    def handle_error(self, request, client_address):
+        # The scraper hangs up on purpose, e.g. on downloads it cancelled.
+        pass
+
+    def add_image_hosts(self, num_hosts: int) -> None:
+        """
+        Also serves on 127.0.0.2 and up, for `num_hosts` hosts in all, or as
+        many of them as the OS has (macOS only has 127.0.0.1 unless more are
+        set up). Runs the new ones on threads of their own.
+        """
+        for n in range(2, num_hosts + 1):
+            try:
+                alias = _AliasServer(("127.0.0.%d" % n, self.server_address[1]),
+                                     self)
+            except OSError:
+                break
+            threading.Thread(target=alias.serve_forever, daemon=True).start()
+            self.image_hosts.append("%s:%d" % alias.server_address)
+
+    def roll(self, request_counter, rate: float, fault_counter: str) -> bool:
+        """
+        Counts the request, and decides whether to inject the fault.
+        """
+        with self.lock:
+            if request_counter is not None:
+                self.counters[request_counter] += 1
+            if self.rng.random() < rate:
+                self.counters[fault_counter] += 1
+                return True
+            return False
+
+
+class _AliasServer(http.server.ThreadingHTTPServer):
+    """
+    Another address for a StandInServer, with the same state (faults, corpus
+    and counters).
+    """
+    daemon_threads = True
+
+    def __init__(self, address, main: StandInServer):
+        self.main = main
+        super().__init__(address, StandInHandler)
+
+    def __getattr__(self, name):
+        return getattr(self.main, name)
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+def _serve(port: int, faults: Faults, seed: int, num_image_hosts: int,
+           ready) -> None:
+    server = StandInServer(port, faults, seed)
+    server.add_image_hosts(num_image_hosts)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_in_process(faults: Faults, seed: int = 0, port: int = 0,
+                     num_image_hosts: int = 8):
+    """
+    Starts the server in a process of its own, so that it doesn't compete with
+    the pipeline for the GIL. Returns (process, port).
+    """
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(
+        target=_serve, args=(port, faults, seed, num_image_hosts, ready),
+        daemon=True)
+    process.start()
+    return process, ready.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--timeout-rate", type=float, default=0)
+    parser.add_argument("--hang-sec", type=float, default=5)
+    parser.add_argument("--svg-rate", type=float, default=0)
+    parser.add_argument("--image-hosts", type=int, default=8)
+    args = parser.parse_args()
+    faults = Faults(args.latency_ms / 1000, args.throttle_rate,
+                    args.timeout_rate, args.hang_sec, args.svg_rate)
+    server = StandInServer(args.port, faults, args.seed)
+    server.add_image_hosts(args.image_hosts)
+    print("Serving on http://127.0.0.1:%d/images/async?q=..., images from %s"
+          % (args.port, ", ".join(server.image_hosts)))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
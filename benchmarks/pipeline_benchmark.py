@@ -0,0 +1,158 @@
+"""
+End-to-end benchmark of a run, offline: the pipeline is pointed at a local
+stand-in for Bing (see bing_stand_in.py) and run on a fresh temporary
+collection, with empty caches.
+
+    python benchmarks/pipeline_benchmark.py [--notes 200] [--latency-ms 50] \\
+        [--throttle-rate 0.05] [--timeout-rate 0.02] [--svg-rate 0.05] [--json]
+
+Reports notes/s, per-query latency percentiles, peak RSS and the bytes
+written to the media folder, plus the per-stage timings from
+instrumentation.py. The numbers only mean something when compared to a run
+with the same options on the same machine.
+
+Needs Pillow and the `anki` package. Doesn't need Anki's GUI.
+"""
+import argparse
+import importlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCHMARKS_DIR)
+# The add-on is a package with relative imports, so it's imported by its
+# folder name from the folder above it.
+sys.path.insert(0, os.path.dirname(ADDON_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+addon = importlib.import_module(os.path.basename(ADDON_DIR))
+pipeline = importlib.import_module(addon.__name__ + ".pipeline")
+scraper = importlib.import_module(addon.__name__ + ".scraper")
+store = importlib.import_module(addon.__name__ + ".store")
+journal = importlib.import_module(addon.__name__ + ".journal")
+instrumentation = importlib.import_module(addon.__name__ + ".instrumentation")
+from anki.collection import Collection  # noqa: E402
+from bing_stand_in import Faults, start_in_process  # noqa: E402
+
+
+def make_collection(directory: str, num_notes: int):
+    """
+    A new collection with `num_notes` Basic notes, one word on the front each.
+    Returns (collection, note ids).
+    """
+    col = Collection(os.path.join(directory, "collection.anki2"))
+    model = col.models.by_name("Basic")
+    deck_id = col.decks.id("Default")
+    note_ids = []
+    for i in range(num_notes):
+        note = col.new_note(model)
+        note["Front"] = "word%d" % i
+        col.add_note(note, deck_id)
+        note_ids.append(note.id)
+    return col, note_ids
+
+
+def make_config(result_count: int, width: int, height: int):
+    with open(os.path.join(ADDON_DIR, "config.json")) as f:
+        config = json.load(f)
+    config["sourceField"] = "Front"
+    config["instrumentation"] = True
+    query_config = config["queryConfigs"][0]
+    query_config.update({"targetField": "Back", "overwrite": "Overwrite",
+                         "resultCount": result_count, "width": width,
+                         "height": height})
+    return config
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux, and in bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--notes", type=int, default=200)
+    parser.add_argument("--results", type=int, default=1,
+                        help="images per note")
+    parser.add_argument("--width", type=int, default=-1)
+    parser.add_argument("--height", type=int, default=260)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--timeout-rate", type=float, default=0)
+    parser.add_argument("--svg-rate", type=float, default=0)
+    parser.add_argument("--timeout-sec", type=float, default=2,
+                        help="the scraper's request timeout, lowered so that "
+                             "hung requests don't dominate the run")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args()
+
+    faults = Faults(latency_sec=args.latency_ms / 1000,
+                    throttle_rate=args.throttle_rate,
+                    timeout_rate=args.timeout_rate,
+                    hang_sec=args.timeout_sec + 1,
+                    svg_rate=args.svg_rate)
+    server, port = start_in_process(faults, args.seed)
+    scraper.BingScraper.SEARCH_FORMAT_URL = (
+        "http://127.0.0.1:%d/images/async?q={}" % port)
+    scraper.BingScraper.TIMEOUT_SEC = args.timeout_sec
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Keep the caches (and the journal) of this run away from the real
+        # ones, and start them out empty.
+        store.USER_FILES_DIR = os.path.join(directory, "user_files")
+        col, note_ids = make_collection(directory, args.notes)
+        config = make_config(args.results, args.width, args.height)
+        run_journal = journal.RunJournal(
+            store.user_files_path("journal.sqlite3"))
+        run_journal.start(config, note_ids)
+
+        start = time.perf_counter()
+        stats = pipeline.run_batch(col, config, note_ids, bypass_cache=True,
+                                   journal=run_journal)
+        elapsed = time.perf_counter() - start
+        col.close()
+
+    with urllib.request.urlopen("http://127.0.0.1:%d/stats" % port) as f:
+        server_stats = json.load(f)
+    server.terminate()
+
+    stages = stats["instrumentation"]["stages"]
+    query = stages.get("query", {})
+    results = {
+        "notes": args.notes,
+        "elapsed_sec": elapsed,
+        "notes_per_sec": args.notes / elapsed,
+        "query_p50_sec": query.get("p50_sec", 0),
+        "query_p95_sec": query.get("p95_sec", 0),
+        "query_p99_sec": query.get("p99_sec", 0),
+        "peak_rss_mb": peak_rss_mb(),
+        "media_bytes_written": stages.get("media_write", {}).get("bytes", 0),
+        "server": server_stats,
+        "stages": stages,
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("%d notes in %.1fs: %.1f notes/s" % (args.notes, elapsed,
+                                             results["notes_per_sec"]))
+    print("Query latency: p50 %.0f ms, p95 %.0f ms, p99 %.0f ms" % (
+        results["query_p50_sec"] * 1000, results["query_p95_sec"] * 1000,
+        results["query_p99_sec"] * 1000))
+    print("Peak RSS: %.0f MB" % results["peak_rss_mb"])
+    print("Written to media: %.1f MB" % (
+        results["media_bytes_written"] / 1024 / 1024))
+    print("Server: %s" % ", ".join("%s %d" % item
+                                   for item in server_stats.items()))
+    print()
+    print(instrumentation.format_summary(stats["instrumentation"]))
+
+
+if __name__ == "__main__":
+    main()
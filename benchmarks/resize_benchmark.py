@@ -0,0 +1,115 @@
+"""
+Micro-benchmark for the resize step: images per second per core, for the old
+resize code and for image_processing.resize_image, on one thread and on a
+process pool with one process per core.
+
+    python benchmarks/resize_benchmark.py [--height 260] [--iterations 5]
+
+Needs Pillow. Doesn't need Anki.
+"""
+import argparse
+import concurrent.futures
+import importlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The add-on is a package with relative imports, so it's imported by its
+# folder name from the folder above it.
+sys.path.insert(0, os.path.dirname(ADDON_DIR))
+resize_image = importlib.import_module(
+    os.path.basename(ADDON_DIR) + ".image_processing").resize_image
+from PIL import Image  # noqa: E402
+
+
+def legacy_resize(img_data: bytes, user_width: int, user_height: int) -> bytes:
+    """
+    The resize code from before image_processing.py, for comparison.
+    """
+    img_io = io.BytesIO(img_data)
+    im = Image.open(img_io)
+    is_gif = getattr(im, 'n_frames', 1) != 1
+    if not (user_width > 0 or user_height > 0) or is_gif:
+        return img_io.getvalue()
+    new_width, new_height = im.width, im.height
+    if user_width > 0:
+        new_width = min(new_width, user_width)
+    if user_height > 0:
+        new_height = min(new_height, user_height)
+    im.thumbnail((new_width, new_height))
+    buf = io.BytesIO()
+    im.save(buf, format=im.format, optimize=True)
+    return buf.getvalue()
+
+
+def make_corpus():
+    """
+    Photo-ish test images of the sizes and formats that Bing tends to return.
+    """
+    corpus = []
+    for image_format, size in [("JPEG", (4000, 3000)), ("JPEG", (1600, 1200)),
+                               ("JPEG", (640, 480)), ("PNG", (2000, 1500)),
+                               ("PNG", (800, 600))]:
+        im = Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100)
+        im = Image.merge("RGB", (im, im.rotate(90, expand=False), im))
+        buf = io.BytesIO()
+        im.save(buf, format=image_format)
+        corpus.append(("%s %dx%d" % (image_format, *size), buf.getvalue()))
+    return corpus
+
+
+def _resize_one(args):
+    fn, data, height = args
+    return len(fn(data, -1, height))
+
+
+def bench_serial(fn, data, height, iterations) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(data, -1, height)
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_pool(fn, corpus, height, iterations, num_processes) -> float:
+    jobs = [(fn, data, height) for _, data in corpus] * iterations
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_processes,
+            mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Warm up the workers so that process startup isn't measured.
+        list(pool.map(_resize_one, jobs[:num_processes]))
+        start = time.perf_counter()
+        list(pool.map(_resize_one, jobs))
+        elapsed = time.perf_counter() - start
+    return len(jobs) / elapsed / num_processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--height", type=int, default=260)
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = make_corpus()
+    print("%-16s %12s %12s %8s" % ("image", "before img/s", "after img/s",
+                                   "speedup"))
+    for name, data in corpus:
+        before = bench_serial(legacy_resize, data, args.height,
+                              args.iterations)
+        after = bench_serial(resize_image, data, args.height, args.iterations)
+        print("%-16s %12.1f %12.1f %7.1fx" % (name, before, after,
+                                              after / before))
+
+    num_processes = os.cpu_count() or 1
+    before = bench_pool(legacy_resize, corpus, args.height, args.iterations,
+                        num_processes)
+    after = bench_pool(resize_image, corpus, args.height, args.iterations,
+                       num_processes)
+    print("\nWhole corpus on %d processes, img/s per core: before %.1f, "
+          "after %.1f (%.1fx)" % (num_processes, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
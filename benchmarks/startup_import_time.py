@@ -0,0 +1,113 @@
+"""
+Measures what loading the add-on adds to Anki's startup, and what the first
+use costs on top of that.
+
+    python benchmarks/startup_import_time.py [--addon-dir DIR] [--repeat 10]
+
+Every measurement is done in a fresh interpreter that has already imported what
+Anki itself has by the time it loads add-ons (aqt, anki, Qt), so only the
+add-on's own imports are counted. "startup" is importing the add-on the way
+Anki does at launch, "first use" is importing gui.py afterwards, like opening
+the dialog does. To compare against an older version, check it out somewhere
+else (e.g. `git worktree add /tmp/before <commit>`) and pass --addon-dir.
+
+Needs Anki's `aqt` package and the dialog to be built (see designer/README.md),
+but doesn't start Anki.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Runs in the fresh interpreter, prints the results as JSON.
+MEASURE = r"""
+import importlib, json, logging, sys, time, types
+import aqt, aqt.qt, aqt.gui_hooks, aqt.utils, aqt.browser, anki.collection
+# A stand-in for the main window, so that the add-on hooks into the GUI like
+# it does in Anki. Only the hooks get registered at import, nothing is called.
+aqt.mw = types.SimpleNamespace()
+sys.path.insert(0, sys.argv[1])
+name = sys.argv[2]
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(name)
+startup = time.perf_counter() - start
+startup_modules = sorted(set(sys.modules) - before)
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(name + ".gui")
+first_use = time.perf_counter() - start
+first_use_modules = sorted(set(sys.modules) - before)
+print(json.dumps({"startup_sec": startup, "first_use_sec": first_use,
+                  "startup_modules": startup_modules,
+                  "first_use_modules": first_use_modules}))
+"""
+
+
+def measure_once(addon_dir: str):
+    addon_dir = os.path.abspath(addon_dir)
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE, os.path.dirname(addon_dir),
+         os.path.basename(addon_dir)],
+        # Not from the add-on's folder, where logging.py would shadow the
+        # standard library's.
+        cwd=BENCHMARKS_DIR, check=True, stdout=subprocess.PIPE,
+        universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def top_level_packages(modules, addon_name: str):
+    """
+    Groups the modules by package, e.g. 12 requests.* modules into "requests".
+    The add-on's own modules are listed one by one, and the C extensions
+    (_socket etc.) that come with the other modules are left out.
+    """
+    packages = set()
+    for module in modules:
+        if module.startswith("_"):
+            continue
+        if module == addon_name or module.startswith(addon_name + "."):
+            packages.add(module)
+        else:
+            packages.add(module.split(".")[0])
+    return sorted(packages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--addon-dir", default=os.path.dirname(BENCHMARKS_DIR),
+                        help="the add-on to measure (defaults to this one)")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of fresh interpreters to take the median "
+                             "of")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args()
+
+    runs = [measure_once(args.addon_dir) for _ in range(args.repeat)]
+    addon_name = os.path.basename(os.path.abspath(args.addon_dir))
+    results = {
+        "startup_ms": statistics.median(r["startup_sec"] for r in runs) * 1000,
+        "first_use_ms": statistics.median(
+            r["first_use_sec"] for r in runs) * 1000,
+        "startup_imports": top_level_packages(runs[0]["startup_modules"],
+                                              addon_name),
+        "first_use_imports": top_level_packages(runs[0]["first_use_modules"],
+                                                addon_name),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("Startup: %.1f ms (median of %d)" % (results["startup_ms"],
+                                               args.repeat))
+    print("  imports: %s" % ", ".join(results["startup_imports"]))
+    print("First use: %.1f ms" % results["first_use_ms"])
+    print("  imports: %s" % ", ".join(results["first_use_imports"]))
+
+
+if __name__ == "__main__":
+    main()
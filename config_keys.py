@@ -0,0 +1,99 @@
+"""
+The config keys and their defaults. Kept apart from ui_helpers so that the
+headless mode (see __main__.py) doesn't need Qt.
+"""
+
+
+class OverwriteValues:
+    """
+    Possible values for the overwrite config.
+    """
+    OVERWRITE = "Overwrite"
+    SKIP = "Skip"
+    APPEND = "Append"
+
+
+class OutputFormatValues:
+    """
+    Possible values for the output format config.
+    """
+    ORIGINAL = "Original"
+    WEBP = "WebP"
+    # Falls back to WebP if this Pillow can't write AVIF.
+    AVIF = "AVIF"
+
+
+class ConfigKeys:
+    """
+    See config.json
+    """
+    SOURCE_FIELD = "sourceField"
+    DELIMITER = "delimiter"
+    LABEL = "label"
+    QUERY_CONFIGS = "queryConfigs"
+    SEARCH_TERM = "searchTerm"
+    TARGET_FIELD = "targetField"
+    RESULT_COUNT = "resultCount"
+    WIDTH = "width"
+    HEIGHT = "height"
+    OVERWRITE = "overwrite"
+    OUTPUT_FORMAT = "format"
+    QUALITY = "quality"
+    SEARCH_CACHE_TTL_DAYS = "searchCacheTtlDays"
+    SEARCH_CACHE_MAX_ENTRIES = "searchCacheMaxEntries"
+    SEARCH_CONCURRENCY = "searchConcurrency"
+    SEARCH_RATE = "searchRatePerSec"
+    MAX_QUERIES_IN_FLIGHT = "maxQueriesInFlight"
+    COMMIT_BATCH_SIZE = "commitBatchSize"
+    IMAGE_PROCESS_WORKERS = "imageProcessWorkers"
+    MAX_IMAGE_BYTES = "maxImageBytes"
+    MAX_IMAGE_PIXELS = "maxImagePixels"
+    MIN_IMAGE_PIXELS = "minImagePixels"
+    IMAGE_CACHE_MAX_MB = "imageCacheMaxMb"
+    IMAGE_CACHE_REVALIDATE_DAYS = "imageCacheRevalidateDays"
+    NEAR_DUPLICATE_THRESHOLD = "nearDuplicateThreshold"
+    MAX_CONNECTIONS_PER_HOST = "maxConnectionsPerHost"
+    CONVERT_ANIMATED = "convertAnimatedGifs"
+    INSTRUMENTATION = "instrumentation"
+    PREFETCH_NEW_NOTES = "prefetchNewNotes"
+    PREFETCH_THREADS = "prefetchThreads"
+    PREFETCH_MAX_KB_PER_SEC = "prefetchMaxKbPerSec"
+
+
+class ConfigDefaults:
+    RESULT_COUNT = 1
+    WIDTH = -1
+    HEIGHT = -1
+    OVERWRITE = "Skip"
+    OUTPUT_FORMAT = OutputFormatValues.ORIGINAL
+    QUALITY = 80
+    IGNORED = "<ignored>"
+    # The placeholder value in the search term the user provides.
+    WORD_PLACEHOLDER = "{}"
+    SEARCH_CACHE_TTL_DAYS = 30
+    SEARCH_CACHE_MAX_ENTRIES = 100000
+    SEARCH_CONCURRENCY = 4
+    SEARCH_RATE = 4.0
+    MAX_QUERIES_IN_FLIGHT = 64
+    COMMIT_BATCH_SIZE = 100
+    # 0 resizes on the download threads instead of in separate processes.
+    IMAGE_PROCESS_WORKERS = 0
+    MAX_IMAGE_BYTES = 20 * 1024 * 1024
+    MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+    MIN_IMAGE_PIXELS = 50 * 50
+    IMAGE_CACHE_MAX_MB = 1024
+    IMAGE_CACHE_REVALIDATE_DAYS = 7
+    # Max number of differing bits (out of 64) between the perceptual hashes of
+    # two images for them to count as the same picture, e.g. 6. Off (-1) by
+    # default, since it costs a second decode of every image.
+    NEAR_DUPLICATE_THRESHOLD = -1
+    CONVERT_ANIMATED = False
+    # Times the stages of a run and writes a report and a Chrome trace to
+    # user_files/instrumentation. See instrumentation.py.
+    INSTRUMENTATION = False
+    # Searches and downloads images in the background for notes as they're
+    # added, using the saved query configs. See prefetch.py.
+    PREFETCH_NEW_NOTES = False
+    PREFETCH_THREADS = 1
+    PREFETCH_MAX_KB_PER_SEC = 256
+    MAX_CONNECTIONS_PER_HOST = 6
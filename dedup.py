@@ -0,0 +1,91 @@
+"""
+Collapses identical queries so that each unique search is only scraped once.
+"""
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from .scraper import QueryResult
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query so that queries that Bing would treat the same way
+    (e.g. differing only by case or spacing) compare equal.
+    """
+    return " ".join(query.split()).casefold()
+
+
+class QueryDeduplicator:
+    """
+    Keeps track of which queries are already being scraped.
+
+    The first QueryResult for a query is the "leader" and actually gets scraped.
+    Later identical QueryResults (e.g. from another note with the same word) are
+    "followers" and just receive a copy of the leader's images.
+
+    Since jobs are submitted a few at a time, a duplicate can show up after its
+    leader has already finished. The images of the last `max_completed`
+    leaders are kept around for that case.
+    """
+    DEFAULT_MAX_COMPLETED = 256
+
+    def __init__(self, max_completed: int = DEFAULT_MAX_COMPLETED):
+        self._followers: Dict[Tuple, List[QueryResult]] = {}
+        self._completed: OrderedDict = OrderedDict()
+        self._max_completed = max_completed
+        # The number of scrape jobs that didn't need to run.
+        self.saved = 0
+
+    @staticmethod
+    def _key(result: QueryResult) -> Tuple:
+        # The dimensions and format are part of the key, since they change the
+        # bytes that come out of the image processing.
+        return (normalize_query(result.query), result.max_results,
+                result.width, result.height, result.output_format,
+                result.quality)
+
+    def add(self, result: QueryResult) -> bool:
+        """
+        Registers the result. Returns True if it is the first of its kind and
+        should be scraped, and False if it will piggyback on an earlier one.
+        """
+        key = QueryDeduplicator._key(result)
+        if key in self._followers:
+            self._followers[key].append(result)
+            self.saved += 1
+            return False
+        self._followers[key] = []
+        return True
+
+    def fan_out(self, leader: QueryResult) -> List[QueryResult]:
+        """
+        Given a scraped leader, returns it along with all of its followers, each
+        of which gets the leader's images.
+        """
+        key = QueryDeduplicator._key(leader)
+        followers = self._followers.pop(key, [])
+        self._completed[key] = leader.images
+        if len(self._completed) > self._max_completed:
+            self._completed.popitem(last=False)
+        return [leader] + [f._replace(images=list(leader.images))
+                           for f in followers]
+
+    def drop(self, leader: QueryResult) -> List[QueryResult]:
+        """
+        Given a leader that failed, returns it along with all of its followers.
+        Unlike `fan_out`, nothing is kept for later duplicates, which get
+        scraped again.
+        """
+        return [leader] + self._followers.pop(QueryDeduplicator._key(leader),
+                                              [])
+
+    def completed(self, result: QueryResult) -> Optional[QueryResult]:
+        """
+        If an identical query already finished, returns the result filled in
+        with its images. Otherwise returns None.
+        """
+        key = QueryDeduplicator._key(result)
+        if key not in self._completed:
+            return None
+        self._completed.move_to_end(key)
+        self.saved += 1
+        return result._replace(images=list(self._completed[key]))
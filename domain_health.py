@@ -0,0 +1,239 @@
+"""
+Keeps track of how well each image host has been doing, so that hosts that keep
+failing aren't retried on every query.
+"""
+import json
+import statistics
+import time
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import urlsplit
+from .store import SqliteStore
+
+
+def domain_of(url: str) -> str:
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class _DomainStats:
+    # Only the most recent latencies are kept for the median.
+    NUM_LATENCIES = 20
+
+    def __init__(self, successes=0, failures=0, consecutive_failures=0,
+                 latencies=(), num_bytes=0, opened_at=0.0):
+        self.successes = successes
+        self.failures = failures
+        self.consecutive_failures = consecutive_failures
+        self.latencies = deque(latencies, maxlen=_DomainStats.NUM_LATENCIES)
+        self.num_bytes = num_bytes
+        # When the circuit breaker last opened (or let a probe through), or 0 if
+        # it's closed.
+        self.opened_at = opened_at
+
+    @property
+    def success_rate(self) -> float:
+        # Smoothed, so that a host with one failure isn't written off.
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def median_latency(self) -> float:
+        return statistics.median(self.latencies) if self.latencies else 0.0
+
+
+class _DomainChanges:
+    """
+    What one scoreboard recorded for a domain since it was loaded. Other
+    scoreboards (the prefetcher's, the other worker processes') share the
+    database, so these are merged into what's on disk instead of overwriting
+    it.
+    """
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.num_bytes = 0
+        self.latencies = deque(maxlen=_DomainStats.NUM_LATENCIES)
+        # Whether there was a success, which resets the consecutive failures.
+        self.reset = False
+        # Since the last success, or since the scoreboard was loaded.
+        self.consecutive_failures = 0
+
+
+class DomainScoreboard(SqliteStore):
+    """
+    Per-domain success rate, latency and bytes downloaded, persisted across
+    runs.
+
+    Candidate URLs are reordered so that hosts that tend to fail or be slow are
+    tried later. A domain that fails `FAILURE_THRESHOLD` times in a row has its
+    circuit opened and is skipped entirely. Every `COOLDOWN_SEC`, a single
+    request is let through as a probe: if it succeeds the circuit closes again,
+    otherwise it stays open for another cooldown. The probe is only used up
+    when its download starts (see `claim`), since ranking a URL doesn't mean
+    it's downloaded.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS domains (
+        domain TEXT PRIMARY KEY,
+        successes INTEGER NOT NULL,
+        failures INTEGER NOT NULL,
+        consecutive_failures INTEGER NOT NULL,
+        latencies TEXT NOT NULL,
+        bytes INTEGER NOT NULL,
+        opened_at REAL NOT NULL
+    );
+    """
+    FAILURE_THRESHOLD = 5
+    COOLDOWN_SEC = 10 * 60
+    # A domain that always fails is moved back by this many positions in the
+    # candidate list, and every second of median latency moves it back one more.
+    MAX_FAILURE_PENALTY = 10
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._domains: Dict[str, _DomainStats] = {}
+        for row in self._conn.execute(
+                "SELECT domain, successes, failures, consecutive_failures, "
+                "latencies, bytes, opened_at FROM domains"):
+            self._domains[row[0]] = _DomainStats(
+                row[1], row[2], row[3], json.loads(row[4]), row[5], row[6])
+        self._changes: Dict[str, _DomainChanges] = {}
+        # Number of candidate URLs skipped because their circuit was open.
+        self.skipped = 0
+
+    def _stats(self, url: str) -> Tuple[_DomainStats, _DomainChanges]:
+        domain = domain_of(url)
+        if domain not in self._domains:
+            self._domains[domain] = _DomainStats()
+        if domain not in self._changes:
+            self._changes[domain] = _DomainChanges()
+        return self._domains[domain], self._changes[domain]
+
+    def _allow(self, stats: _DomainStats, now: float) -> bool:
+        # Half-open once the cooldown is over, see `claim`.
+        return (stats.consecutive_failures < DomainScoreboard.FAILURE_THRESHOLD
+                or now - stats.opened_at >= DomainScoreboard.COOLDOWN_SEC)
+
+    def claim(self, url: str) -> bool:
+        """
+        Called right before downloading the URL. Returns False if its circuit
+        is open, e.g. because another download already took the probe since
+        the URL was ranked.
+        """
+        now = time.time()
+        with self._lock:
+            stats = self._domains.get(domain_of(url))
+            if stats is None:
+                return True
+            if not self._allow(stats, now):
+                self.skipped += 1
+                return False
+            if stats.consecutive_failures >= DomainScoreboard.FAILURE_THRESHOLD:
+                # Half-open: this one is the probe, everyone else is held off
+                # for another cooldown.
+                stats.opened_at = now
+            return True
+
+    def rank(self, urls: List[str]) -> List[str]:
+        """
+        Returns the URLs that are worth trying, best first. Otherwise, keeps the
+        order of the search results as much as possible.
+        """
+        now = time.time()
+        scored = []
+        with self._lock:
+            for position, url in enumerate(urls):
+                # Hosts we've never heard of have nothing to go on.
+                stats = self._domains.get(domain_of(url), _DomainStats())
+                if not self._allow(stats, now):
+                    self.skipped += 1
+                    continue
+                penalty = ((1 - stats.success_rate) * DomainScoreboard.MAX_FAILURE_PENALTY
+                           + stats.median_latency)
+                scored.append((position + penalty, position, url))
+        return [url for _, _, url in sorted(scored)]
+
+    def skip_failing(self, urls: Iterable[str]) -> Iterator[str]:
+        """
+        Like `rank`, but for URLs that arrive one at a time, so they can only be
+        skipped, not reordered.
+        """
+        for url in urls:
+            with self._lock:
+                stats = self._domains.get(domain_of(url), _DomainStats())
+                allowed = self._allow(stats, time.time())
+                if not allowed:
+                    self.skipped += 1
+            if allowed:
+                yield url
+
+    def record_success(self, url: str, latency_sec: float,
+                       num_bytes: int) -> None:
+        with self._lock:
+            stats, changes = self._stats(url)
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.opened_at = 0.0
+            stats.latencies.append(latency_sec)
+            stats.num_bytes += num_bytes
+            changes.successes += 1
+            changes.reset = True
+            changes.consecutive_failures = 0
+            changes.latencies.append(latency_sec)
+            changes.num_bytes += num_bytes
+
+    def record_failure(self, url: str, latency_sec: float) -> None:
+        with self._lock:
+            stats, changes = self._stats(url)
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            stats.latencies.append(latency_sec)
+            changes.failures += 1
+            changes.consecutive_failures += 1
+            changes.latencies.append(latency_sec)
+            if stats.consecutive_failures == DomainScoreboard.FAILURE_THRESHOLD:
+                stats.opened_at = time.time()
+
+    def _merge(self, domain: str, changes: _DomainChanges) -> None:
+        """
+        Adds `changes` to the domain's row, as it is on disk now.
+        """
+        row = self._conn.execute(
+            "SELECT successes, failures, consecutive_failures, latencies, "
+            "bytes, opened_at FROM domains WHERE domain = ?",
+            (domain,)).fetchone()
+        on_disk = _DomainStats()
+        if row is not None:
+            on_disk = _DomainStats(row[0], row[1], row[2], json.loads(row[3]),
+                                   row[4], row[5])
+        consecutive_failures = changes.consecutive_failures
+        if not changes.reset:
+            consecutive_failures += on_disk.consecutive_failures
+        opened_at = 0.0
+        if consecutive_failures >= DomainScoreboard.FAILURE_THRESHOLD:
+            opened_at = (max(on_disk.opened_at,
+                             self._domains[domain].opened_at) or time.time())
+        latencies = (list(on_disk.latencies) + list(changes.latencies))[
+            -_DomainStats.NUM_LATENCIES:]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO domains (domain, successes, failures, "
+            "consecutive_failures, latencies, bytes, opened_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (domain, on_disk.successes + changes.successes,
+             on_disk.failures + changes.failures, consecutive_failures,
+             json.dumps(latencies), on_disk.num_bytes + changes.num_bytes,
+             opened_at))
+
+    def close(self) -> None:
+        with self._lock:
+            # Read and write in one transaction, so that two scoreboards
+            # closing at once don't lose each other's changes.
+            self._conn.commit()
+            self._conn.execute("BEGIN IMMEDIATE")
+            for domain, changes in self._changes.items():
+                self._merge(domain, changes)
+            self._changes = {}
+            super().close()
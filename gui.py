@@ -0,0 +1,215 @@
+"""
+The add-on's GUI: the dialog for configuring a run, and running it from the
+card browser. Only imported on first use, see hooks.py.
+"""
+import time
+from typing import Optional, Tuple
+
+import aqt
+from aqt import mw
+from aqt.utils import showInfo
+# TODO(louisli): Try not to * import
+from aqt.qt import *
+
+# See main.ui
+from .designer.main import Ui_Dialog
+from .ui_helpers import ConfigDefaults, ConfigKeys, COLUMN_LABELS
+from .ui_helpers import make_target_field_select, make_dimension_spin_box, make_overwrite_select, make_result_count_box, serialize_config_from_ui
+from .ui_helpers import make_output_format_select, make_quality_box
+from .journal import RunJournal
+from .pipeline import ProgressReporter, format_summary, open_journal, run_batch
+from .prefetch import Prefetcher
+from .scheduler import RunProgress, format_progress
+
+# Started on the first added note with prefetchNewNotes on, see prefetch_note.
+_prefetcher: Optional[Prefetcher] = None
+
+
+def open_add_images_dialog(browser: aqt.browser.Browser) -> None:
+    """
+    Triggered after selecting notes in the browser and clicking "add"
+
+    Opens up the dialog to configure the image search.
+    """
+    mw = browser.mw
+
+    selected_notes = browser.selectedNotes()
+    if not selected_notes:
+        aqt.utils.tooltip("No notes were selected.")
+        return
+
+    # Set up the dialog using Qt, importing a UI config.
+    dialog = QDialog(browser)
+    form = Ui_Dialog()
+    form.setupUi(dialog)
+    config = mw.addonManager.getConfig(__name__)
+
+    # Using the first note in the collection, read the possible fields to
+    # configure source/target fields. Set the default field from the config.
+    note_fields = mw.col.get_note(selected_notes[0]).keys()
+    form.sourceField.addItems(note_fields)
+    config_src_field = config[ConfigKeys.SOURCE_FIELD]
+    if config_src_field in note_fields:
+        form.sourceField.setCurrentIndex(note_fields.index(config_src_field))
+
+    form.gridLayout.setColumnStretch(1, 1)
+    form.gridLayout.setColumnMinimumWidth(1, 120)
+
+    for i, title in enumerate(COLUMN_LABELS):
+        form.gridLayout.addWidget(QLabel(title), 0, i)
+
+    for i, sq in enumerate(config[ConfigKeys.QUERY_CONFIGS]):
+        label = sq[ConfigKeys.LABEL]
+        search_term = sq[ConfigKeys.SEARCH_TERM]
+        target_field = sq[ConfigKeys.TARGET_FIELD]
+        result_count = sq.get(
+            ConfigKeys.RESULT_COUNT,
+            ConfigDefaults.RESULT_COUNT)
+        width = sq.get(ConfigKeys.WIDTH, ConfigDefaults.WIDTH)
+        height = sq.get(ConfigKeys.HEIGHT, ConfigDefaults.HEIGHT)
+        overwrite = sq.get(ConfigKeys.OVERWRITE, ConfigDefaults.OVERWRITE)
+        output_format = sq.get(ConfigKeys.OUTPUT_FORMAT,
+                               ConfigDefaults.OUTPUT_FORMAT)
+        quality = sq.get(ConfigKeys.QUALITY, ConfigDefaults.QUALITY)
+
+        # Shift +1 to account for the column headers.
+        row_idx = i + 1
+
+        # Add the columns for this search query
+        # NOTE: This section needs to be synchronized with serialize_config_from_ui
+        # and COLUMN_LABELS
+        form.gridLayout.addWidget(QLineEdit(label), row_idx, 0)
+        form.gridLayout.addWidget(QLineEdit(search_term), row_idx, 1)
+        form.gridLayout.addWidget(make_target_field_select(note_fields,
+                                                           target_field),
+                                  row_idx, 2)
+        form.gridLayout.addWidget(
+            make_result_count_box(result_count), row_idx, 3)
+        form.gridLayout.addWidget(make_overwrite_select(overwrite), row_idx, 4)
+        form.gridLayout.addLayout(make_dimension_spin_box(width, "Width"),
+                                  row_idx, 5)
+        form.gridLayout.addLayout(make_dimension_spin_box(height, "Height"),
+                                  row_idx, 6)
+        form.gridLayout.addWidget(make_output_format_select(output_format),
+                                  row_idx, 7)
+        form.gridLayout.addWidget(make_quality_box(quality), row_idx, 8)
+
+    # TODO: document this
+    if not dialog.exec():
+        return
+    scrape_images_and_update(form, selected_notes, browser)
+
+
+def scrape_images_and_update(form, note_ids, browser):
+    """
+    Main entry point for logic that runs after the start button is pressed.
+    """
+    # Save new config to disk, then use new config to scrape images.
+    new_config = serialize_config_from_ui(
+        form, mw.addonManager.getConfig(__name__))
+    mw.addonManager.writeConfig(__name__, new_config)
+
+    journal = open_journal()
+    journal.start(new_config, note_ids)
+    run_in_browser(new_config, note_ids, browser,
+                   bypass_cache=form.bypassCache.isChecked(), journal=journal)
+
+
+def resume_last_run(browser: aqt.browser.Browser) -> None:
+    """
+    Picks up the last run where it left off, if it didn't finish. Entries that
+    were already written to their notes are skipped, and image URLs that were
+    already found are reused.
+    """
+    journal = open_journal()
+    last_run = journal.resume()
+    if last_run is None:
+        journal.close()
+        aqt.utils.tooltip("There is no unfinished run to resume.")
+        return
+    config, note_ids = last_run
+    run_in_browser(config, note_ids, browser, bypass_cache=False,
+                   journal=journal)
+
+
+class GuiReporter(ProgressReporter):
+    """
+    Shows the progress in Anki's progress dialog. Closing the dialog cancels
+    the run.
+
+    Progress comes in every 0.1s, so a message is shown under it for
+    `MESSAGE_SEC` instead of being replaced right away.
+    """
+    MESSAGE_SEC = 5
+
+    def __init__(self):
+        # (message, when), replaced as a whole since it's set from any thread.
+        self._message: Optional[Tuple[str, float]] = None
+
+    def message(self, label: str) -> None:
+        self._message = (label, time.monotonic())
+        mw.taskman.run_on_main(lambda: mw.progress.update(label))
+
+    def progress(self, progress: RunProgress) -> None:
+        label = format_progress(progress)
+        message = self._message
+        if (message is not None and
+                time.monotonic() - message[1] < GuiReporter.MESSAGE_SEC):
+            label += "\n" + message[0]
+        mw.progress.update(label=label,
+                           value=progress.notes_completed,
+                           max=progress.notes_total)
+        QApplication.instance().processEvents()
+
+    def cancelled(self) -> bool:
+        return mw.progress.want_cancel()
+
+
+def run_in_browser(config, note_ids, browser, bypass_cache: bool,
+                   journal: RunJournal) -> None:
+    """
+    Runs the batch (see pipeline.run_batch) with a progress dialog, then
+    shows the summary.
+    """
+    browser.begin_reset()
+    mw.progress.start(immediate=True)
+    # The run gets all of the bandwidth.
+    if _prefetcher is not None:
+        _prefetcher.pause()
+    try:
+        stats = run_batch(mw.col, config, note_ids, bypass_cache=bypass_cache,
+                          journal=journal, reporter=GuiReporter())
+    finally:
+        if _prefetcher is not None:
+            _prefetcher.resume()
+        mw.progress.finish()
+
+        # No idea what this line does but the other guy had it.
+        # No idea what any of this does, actually.
+        QApplication.instance().processEvents()
+        browser.end_reset()
+        mw.requireReset()
+    showInfo(format_summary(stats), parent=browser)
+
+
+def prefetch_note(note, config) -> None:
+    """
+    Queues up the new note's queries for prefetching.
+    """
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = Prefetcher(
+            config,
+            num_threads=config.get(ConfigKeys.PREFETCH_THREADS,
+                                   ConfigDefaults.PREFETCH_THREADS),
+            max_bytes_per_sec=1024 * config.get(
+                ConfigKeys.PREFETCH_MAX_KB_PER_SEC,
+                ConfigDefaults.PREFETCH_MAX_KB_PER_SEC))
+    _prefetcher.add_note(note.id, dict(note.items()), config)
+
+
+def close_prefetcher() -> None:
+    global _prefetcher
+    if _prefetcher is not None:
+        _prefetcher.close()
+        _prefetcher = None
@@ -0,0 +1,84 @@
+"""
+Everything that's hooked into Anki when it loads the add-on. This is imported
+on every start of Anki, so it stays light: the scraping engine and the dialog
+(gui.py and everything behind it) are only imported once they're needed, or
+warmed up in the background once Anki has settled down (see `warm_up`).
+"""
+import importlib
+import sys
+import threading
+
+import aqt
+from aqt import mw
+
+from .config_keys import ConfigDefaults, ConfigKeys
+from .logging import logger
+
+# How long after the profile opens to start warming up, so that it doesn't
+# compete with Anki's own startup.
+WARM_UP_DELAY_MS = 5000
+# Imported by `warm_up`. Only the modules that don't touch Qt, those have to
+# be imported on the main thread.
+WARM_UP_MODULES = ("pipeline", "prefetch")
+
+
+def _gui():
+    """
+    Imports gui.py (and with it the scraping engine) on first use.
+    """
+    return importlib.import_module(".gui", __package__)
+
+
+def setup_menu(browser: aqt.browser.Browser) -> None:
+    """
+    Adds the button to add images on init of the card browser.
+    """
+    menu = browser.form.menuEdit
+    menu.addSeparator()
+    new_action = menu.addAction(
+        'FawsImageSearch: Add images to the selected cards')
+    new_action.triggered.connect(
+        lambda _, b=browser: _gui().open_add_images_dialog(b))
+    resume_action = menu.addAction(
+        'FawsImageSearch: Resume the last unfinished run')
+    resume_action.triggered.connect(
+        lambda _, b=browser: _gui().resume_last_run(b))
+
+
+def on_note_added(note) -> None:
+    """
+    Queues up the new note's queries for prefetching, if it's turned on.
+    """
+    config = mw.addonManager.getConfig(__name__)
+    if not config.get(ConfigKeys.PREFETCH_NEW_NOTES,
+                      ConfigDefaults.PREFETCH_NEW_NOTES):
+        return
+    _gui().prefetch_note(note, config)
+
+
+def close_prefetcher() -> None:
+    # If the GUI was never used, there's no prefetcher to close.
+    gui = sys.modules.get(__package__ + ".gui")
+    if gui is not None:
+        gui.close_prefetcher()
+
+
+def _import_in_background() -> None:
+    try:
+        for name in WARM_UP_MODULES:
+            importlib.import_module("." + name, __package__)
+    except Exception as e:
+        # It'll be tried again (and the error shown) on first use.
+        logger.exception(e)
+
+
+def warm_up() -> None:
+    """
+    Imports the scraping engine on a background thread a while after the
+    profile opens, so that the first run doesn't wait for it either.
+    """
+    mw.progress.timer(
+        WARM_UP_DELAY_MS,
+        lambda: threading.Thread(target=_import_in_background,
+                                 name="faws-warm-up", daemon=True).start(),
+        False)
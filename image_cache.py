@@ -0,0 +1,166 @@
+"""
+A disk cache of original (not resized) images, so that re-running a batch with
+different dimensions doesn't have to download everything again.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from typing import BinaryIO, NamedTuple, Optional
+from .store import SqliteStore
+
+
+class CachedImage(NamedTuple):
+    content_hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # False if it's been long enough that it should be revalidated with the
+    # server before being used.
+    fresh: bool
+
+
+class ImageCache(SqliteStore):
+    """
+    Content-addressed: every distinct image is stored once, in
+    `directory/<hash[:2]>/<hash>`, no matter how many URLs point to it.
+
+    The total size of the files is kept under `max_bytes` by evicting the least
+    recently used ones. Entries older than `revalidate_after_sec` are still
+    used, but only after the server confirms (through ETag/Last-Modified)
+    that they haven't changed.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS urls (
+        url TEXT PRIMARY KEY,
+        hash TEXT NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        validated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash);
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        accessed REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed);
+    """
+    # When over budget, evict down to this fraction of it, so that eviction
+    # doesn't run on every single store.
+    EVICT_TO_FRACTION = 0.9
+
+    def __init__(self, path: str, directory: str, max_bytes: int,
+                 revalidate_after_sec: float):
+        super().__init__(path)
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._revalidate_after_sec = revalidate_after_sec
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self._directory, content_hash[:2], content_hash)
+
+    def lookup(self, url: str) -> Optional[CachedImage]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hash, etag, last_modified, validated FROM urls "
+                "WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        content_hash, etag, last_modified, validated = row
+        return CachedImage(content_hash, etag, last_modified,
+                           fresh=time.time() - validated < self._revalidate_after_sec)
+
+    def open(self, cached: CachedImage) -> Optional[BinaryIO]:
+        """
+        Opens the cached image for reading, or returns None if it's gone (e.g.
+        it was just evicted).
+        """
+        try:
+            f = open(self._blob_path(cached.content_hash), "rb")
+        except OSError:
+            self.misses += 1
+            return None
+        with self._lock:
+            self._conn.execute("UPDATE blobs SET accessed = ? WHERE hash = ?",
+                               (time.time(), cached.content_hash))
+            self._conn.commit()
+            self.hits += 1
+        return f
+
+    def mark_validated(self, url: str) -> None:
+        """
+        Called when the server said (with a 304) that the cached copy is still
+        good.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE urls SET validated = ? WHERE url = ?",
+                               (time.time(), url))
+            self._conn.commit()
+
+    def store(self, url: str, body: BinaryIO, etag: Optional[str],
+              last_modified: Optional[str]) -> None:
+        """
+        Copies the image in `body` into the cache. `body` is rewound both before
+        and after.
+        """
+        body.seek(0)
+        digest = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+        size = 0
+        with os.fdopen(fd, "wb") as tmp:
+            for chunk in iter(lambda: body.read(64 * 1024), b""):
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        body.seek(0)
+        content_hash = digest.hexdigest()
+        blob_path = self._blob_path(content_hash)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        now = time.time()
+        with self._lock:
+            # The cache is shared with the prefetcher and the other processes
+            # of a sharded run, so the total is only known once the database
+            # is locked against their stores.
+            self._conn.commit()
+            self._conn.execute("BEGIN IMMEDIATE")
+            exists = self._conn.execute(
+                "SELECT 1 FROM blobs WHERE hash = ?",
+                (content_hash,)).fetchone() is not None
+            if exists:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, blob_path)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs (hash, size, accessed) "
+                "VALUES (?, ?, ?)", (content_hash, size, now))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO urls "
+                "(url, hash, etag, last_modified, validated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (url, content_hash, etag, last_modified, now))
+            total_bytes = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total_bytes > self._max_bytes:
+                self._evict(total_bytes)
+            self._conn.commit()
+
+    def _evict(self, total_bytes: int) -> None:
+        target = self._max_bytes * ImageCache.EVICT_TO_FRACTION
+        for content_hash, size in self._conn.execute(
+                "SELECT hash, size FROM blobs ORDER BY accessed").fetchall():
+            if total_bytes <= target:
+                break
+            try:
+                os.remove(self._blob_path(content_hash))
+            except OSError:
+                pass
+            self._conn.execute("DELETE FROM blobs WHERE hash = ?",
+                               (content_hash,))
+            self._conn.execute("DELETE FROM urls WHERE hash = ?",
+                               (content_hash,))
+            total_bytes -= size
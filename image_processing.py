@@ -0,0 +1,182 @@
+"""
+Decoding and resizing of downloaded images.
+
+This module doesn't import anything from Anki or the parts of the add-on that
+need it, so that it can be run in worker processes.
+"""
+import concurrent.futures
+import io
+import multiprocessing
+from typing import BinaryIO, Optional, Tuple, Union
+from .config_keys import OutputFormatValues
+
+
+def sniff_image_size(header: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Tries to read the dimensions of an image from its first few bytes. Returns
+    None if they can't be read (yet), e.g. because the header is longer than
+    what has been downloaded so far.
+    """
+    # Check README for why this import is here.
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(header)) as im:
+            return im.size
+    except Exception:
+        # Depending on the format and where the data is cut off, Pillow raises
+        # all kinds of things here.
+        return None
+
+
+def _read_all(img_data: Union[bytes, BinaryIO]) -> bytes:
+    if isinstance(img_data, bytes):
+        return img_data
+    img_data.seek(0)
+    return img_data.read()
+
+
+def resize_image(img_data: Union[bytes, BinaryIO], user_width: int,
+                 user_height: int) -> bytes:
+    """
+    Shrinks the image to fit in `user_width` x `user_height` (either of which
+    can be <= 0 for no limit), keeping the aspect ratio and format.
+
+    `img_data` is either the bytes or a file with the image. The original bytes
+    are returned as is (not copied) if there's nothing to do. Raises
+    PIL.UnidentifiedImageError if the data isn't an image.
+    """
+    # Check README for why this import is here.
+    from PIL import Image
+
+    # Opening only reads the header, so this is cheap, and it checks that the
+    # data is an image at all.
+    im = Image.open(io.BytesIO(img_data) if isinstance(img_data, bytes)
+                    else img_data)
+    should_resize = user_width > 0 or user_height > 0
+
+    # GIFs can't be resized, again according to the last dude, I'll take
+    # his word for it.
+    is_gif = getattr(im, 'n_frames', 1) != 1
+    if not should_resize or is_gif:
+        return _read_all(img_data)
+
+    box_width = min(im.width, user_width) if user_width > 0 else im.width
+    box_height = min(im.height, user_height) if user_height > 0 else im.height
+    scale = min(box_width / im.width, box_height / im.height)
+    if scale >= 1:
+        return _read_all(img_data)
+    target = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+
+    image_format = im.format
+    # For JPEGs, this makes the decoder do most of the downscaling (by 1/2, 1/4
+    # or 1/8) while decoding, which is much cheaper than decoding every pixel
+    # and throwing most of them away. It's a no-op for other formats.
+    # thumbnail() also does this, but asks for twice the target size.
+    im.draft(None, target)
+    im.thumbnail(target)
+    buf = io.BytesIO()
+    im.save(buf, format=image_format, optimize=True)
+    return buf.getvalue()
+
+
+def _pillow_format(output_format: str) -> Optional[str]:
+    """
+    The Pillow format to save as, or None to keep the original format.
+    """
+    # Check README for why this import is here.
+    from PIL import Image
+    Image.init()
+    if output_format == OutputFormatValues.AVIF and "AVIF" in Image.SAVE:
+        return "AVIF"
+    if (output_format in (OutputFormatValues.WEBP, OutputFormatValues.AVIF)
+            and "WEBP" in Image.SAVE):
+        return "WEBP"
+    return None
+
+
+def convert_image(img_data: bytes, output_format: str, quality: int,
+                  convert_animated: bool) -> bytes:
+    """
+    Re-encodes the image as WebP or AVIF, which are usually a lot smaller than
+    PNGs and GIFs.
+
+    The original bytes are returned as is when the output format is
+    "Original", when Pillow can't write the format, when the image is animated
+    and `convert_animated` is off, or when the converted image isn't smaller.
+    Animated images are only converted to WebP.
+    """
+    pillow_format = _pillow_format(output_format)
+    if pillow_format is None:
+        return img_data
+
+    # Check README for why this import is here.
+    from PIL import Image
+    im = Image.open(io.BytesIO(img_data))
+    is_animated = getattr(im, 'n_frames', 1) != 1
+    if is_animated and (not convert_animated or pillow_format != "WEBP"):
+        return img_data
+    if not is_animated and im.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in im.getbands() or "transparency" in im.info
+        im = im.convert("RGBA" if has_alpha else "RGB")
+
+    buf = io.BytesIO()
+    try:
+        im.save(buf, format=pillow_format, quality=quality,
+                save_all=is_animated)
+    except (OSError, ValueError):
+        # E.g. a mode the encoder doesn't support. Keeping the original is
+        # always fine.
+        return img_data
+    converted = buf.getvalue()
+    return converted if len(converted) < len(img_data) else img_data
+
+
+def process_image(img_data: Union[bytes, BinaryIO], user_width: int,
+                  user_height: int, output_format: str, quality: int,
+                  convert_animated: bool) -> Tuple[bytes, int]:
+    """
+    Resizes, then converts the image. See `resize_image` and `convert_image`.
+
+    Returns the final bytes, and the size the image would've been without the
+    conversion.
+    """
+    resized = resize_image(img_data, user_width, user_height)
+    return (convert_image(resized, output_format, quality, convert_animated),
+            len(resized))
+
+
+class ImageProcessor:
+    """
+    Runs the CPU heavy image work, either right on the calling thread or in a
+    pool of `num_processes` worker processes, which don't contend for the GIL
+    with the download threads.
+
+    The process pool is off by default inside of Anki: the packaged Anki
+    builds can't always start Python subprocesses.
+    """
+
+    def __init__(self, num_processes: int = 0):
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if num_processes > 0:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_processes,
+                mp_context=multiprocessing.get_context("spawn"))
+
+    def process(self, img_data: Union[bytes, BinaryIO], user_width: int,
+                user_height: int, output_format: str = OutputFormatValues.ORIGINAL,
+                quality: int = 80,
+                convert_animated: bool = False) -> Tuple[bytes, int]:
+        """
+        See `process_image`. Blocks until done.
+        """
+        args = (user_width, user_height, output_format, quality,
+                convert_animated)
+        if self._pool is None:
+            return process_image(img_data, *args)
+        # Files can't be sent to another process.
+        return self._pool.submit(process_image, _read_all(img_data),
+                                 *args).result()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,322 @@
+"""
+Optional timing of the stages of a run (search, URL extraction, downloads,
+resizing, media writes, note updates), to tell where the time of a slow run
+went.
+
+It's off unless the "instrumentation" config is on. While it's off, `span`
+hands back a shared do-nothing context manager and `record`/`sample` return
+straight away, so leaving the calls in costs next to nothing.
+"""
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class LatencyHistogram:
+    """
+    Durations bucketed on a log scale, every bucket 10% wider than the one
+    before it, so that the memory used stays the same no matter how many are
+    recorded. Percentiles are accurate to within a bucket.
+    """
+    MIN_SEC = 1e-6
+    GROWTH = 1.1
+
+    def __init__(self):
+        # bucket index -> count
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+        self.num_bytes = 0
+
+    def record(self, sec: float, num_bytes: int = 0) -> None:
+        if sec <= LatencyHistogram.MIN_SEC:
+            index = 0
+        else:
+            index = int(math.log(sec / LatencyHistogram.MIN_SEC) /
+                        math.log(LatencyHistogram.GROWTH)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total_sec += sec
+        self.max_sec = max(self.max_sec, sec)
+        self.num_bytes += num_bytes
+
+    def percentile(self, p: float) -> float:
+        """
+        The upper bound of the bucket that the `p`th percentile falls in.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(p / 100 * self.count)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        upper = LatencyHistogram.MIN_SEC * LatencyHistogram.GROWTH ** index
+        return min(upper, self.max_sec)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total_sec += other.total_sec
+        self.max_sec = max(self.max_sec, other.max_sec)
+        self.num_bytes += other.num_bytes
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_sec": self.total_sec,
+            "p50_sec": self.percentile(50),
+            "p95_sec": self.percentile(95),
+            "p99_sec": self.percentile(99),
+            "max_sec": self.max_sec,
+            "bytes": self.num_bytes,
+        }
+
+
+class Gauge:
+    """
+    Samples of something like a queue depth.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self, value: int) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Gauge") -> None:
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def to_dict(self) -> dict:
+        return {
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+        }
+
+
+class _Span:
+    """
+    Times the `with` block and records it when it's done. Set `num_bytes` in
+    the block to record how much data the stage handled.
+    """
+    __slots__ = ("_instrumentation", "_stage", "_pool", "_start", "num_bytes")
+
+    def __init__(self, instrumentation: "Instrumentation", stage: str,
+                 pool: Optional[str]):
+        self._instrumentation = instrumentation
+        self._stage = stage
+        self._pool = pool
+        self.num_bytes = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._instrumentation.record(self._stage, self._start, self.num_bytes,
+                                     self._pool)
+
+
+class _NullSpan:
+    """
+    What `span` hands back while instrumentation is off.
+    """
+    num_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation:
+    """
+    Collects a latency histogram per stage, queue depth samples, and how busy
+    each thread pool was. With `trace`, every span is also kept as a Chrome
+    trace event (up to MAX_TRACE_EVENTS), see `export_chrome_trace`.
+
+    Thread-safe. The worker processes of a sharded run each have their own,
+    which are merged into the main one with `merge`.
+    """
+    # Around 100 bytes each once exported.
+    MAX_TRACE_EVENTS = 200000
+
+    def __init__(self, enabled: bool = False, trace: bool = False):
+        self.enabled = enabled
+        self._trace = enabled and trace
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stages: Dict[str, LatencyHistogram] = {}
+        self._gauges: Dict[str, Gauge] = {}
+        # pool name -> seconds its threads spent in spans
+        self._busy_sec: Dict[str, float] = {}
+        self._pool_sizes: Dict[str, int] = {}
+        self._trace_events: List[dict] = []
+
+    def span(self, stage: str, pool: Optional[str] = None):
+        """
+        A context manager that times its block as one occurrence of `stage`.
+        If `pool` is given, the time also counts as that thread pool being busy.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage, pool)
+
+    def record(self, stage: str, start: float, num_bytes: int = 0,
+               pool: Optional[str] = None) -> None:
+        """
+        Records one occurrence of `stage` that started at `start` (from
+        time.perf_counter()) and ended now.
+        """
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = LatencyHistogram()
+            histogram.record(end - start, num_bytes)
+            if pool is not None:
+                self._busy_sec[pool] = self._busy_sec.get(pool, 0) + end - start
+            if self._trace and len(self._trace_events) < Instrumentation.MAX_TRACE_EVENTS:
+                self._trace_events.append({
+                    "name": stage,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"bytes": num_bytes},
+                })
+
+    def add_bytes(self, stage: str, num_bytes: int) -> None:
+        """
+        Counts bytes towards a stage without timing anything.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = LatencyHistogram()
+            histogram.num_bytes += num_bytes
+
+    def sample(self, gauge: str, value: int) -> None:
+        """
+        Records the current value of something like a queue depth.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if gauge not in self._gauges:
+                self._gauges[gauge] = Gauge()
+            self._gauges[gauge].sample(value)
+
+    def set_pool_size(self, pool: str, num_threads: int) -> None:
+        """
+        Sets the number of threads in a pool, for its utilization.
+        """
+        self._pool_sizes[pool] = num_threads
+
+    def snapshot(self) -> dict:
+        """
+        The collected data, to be sent over to another process and merged
+        there. Hands over the trace events collected since the last snapshot.
+        """
+        with self._lock:
+            trace_events = self._trace_events
+            self._trace_events = []
+            return {
+                "stages": dict(self._stages),
+                "gauges": dict(self._gauges),
+                "busy_sec": dict(self._busy_sec),
+                "pool_sizes": dict(self._pool_sizes),
+                "trace_events": trace_events,
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        Adds in a `snapshot` from another Instrumentation. Everything but the
+        trace events is a running total, so only the last snapshot of each
+        Instrumentation should be merged; trace events can be merged as they
+        come, see `add_trace_events`.
+        """
+        with self._lock:
+            for stage, histogram in snapshot["stages"].items():
+                self._stages.setdefault(stage, LatencyHistogram()).merge(histogram)
+            for name, gauge in snapshot["gauges"].items():
+                self._gauges.setdefault(name, Gauge()).merge(gauge)
+            for pool, busy_sec in snapshot["busy_sec"].items():
+                self._busy_sec[pool] = self._busy_sec.get(pool, 0) + busy_sec
+            for pool, num_threads in snapshot["pool_sizes"].items():
+                self._pool_sizes[pool] = self._pool_sizes.get(
+                    pool, 0) + num_threads
+        self.add_trace_events(snapshot.get("trace_events", []))
+
+    def add_trace_events(self, trace_events: List[dict]) -> None:
+        with self._lock:
+            room = Instrumentation.MAX_TRACE_EVENTS - len(self._trace_events)
+            self._trace_events.extend(trace_events[:max(room, 0)])
+
+    def to_dict(self) -> dict:
+        wall_sec = time.perf_counter() - self._started
+        with self._lock:
+            return {
+                "wall_sec": wall_sec,
+                "stages": {stage: histogram.to_dict()
+                           for stage, histogram in self._stages.items()},
+                "queue_depths": {name: gauge.to_dict()
+                                 for name, gauge in self._gauges.items()},
+                "thread_utilization": {
+                    pool: self._busy_sec.get(pool, 0) /
+                    (wall_sec * num_threads)
+                    for pool, num_threads in self._pool_sizes.items()},
+            }
+
+    def export_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def export_chrome_trace(self, path: str) -> None:
+        """
+        Writes the spans in the Trace Event Format, which can be opened in
+        chrome://tracing or https://ui.perfetto.dev.
+        """
+        with self._lock:
+            events = list(self._trace_events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def format_summary(data: dict) -> str:
+    """
+    The output of `Instrumentation.to_dict` as a table, for the summary at the
+    end of a run.
+    """
+    lines = ["Stage: count, p50 / p95 / p99, total, MB"]
+    for stage, s in sorted(data["stages"].items()):
+        lines.append("  %s: %d, %.1f / %.1f / %.1f ms, %.1fs, %.1f MB" % (
+            stage, s["count"], s["p50_sec"] * 1000, s["p95_sec"] * 1000,
+            s["p99_sec"] * 1000, s["total_sec"], s["bytes"] / 1024 / 1024))
+    for name, g in sorted(data["queue_depths"].items()):
+        lines.append("  %s: %.1f on average, %d at most" % (
+            name, g["mean"], g["max"]))
+    for pool, utilization in sorted(data["thread_utilization"].items()):
+        lines.append("  %s busy: %.0f%%" % (pool, utilization * 100))
+    return "\n".join(lines)
@@ -0,0 +1,160 @@
+"""
+A journal of the progress of a batch run, so that a run that dies partway
+through can be resumed without redoing the work that already finished.
+"""
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+from .store import SqliteStore
+
+# (note id, query config label, query)
+JournalKey = Tuple[int, str, str]
+
+
+class JournalState:
+    """
+    The states that a (note, query config) entry goes through, in order.
+
+    Entries are only written once they're past PENDING, so a missing entry is
+    PENDING.
+    """
+    PENDING = "pending"
+    # The image URLs are known.
+    SEARCHED = "searched"
+    # The images were downloaded, but not yet written to the note.
+    DOWNLOADED = "downloaded"
+    # The note was written to the collection.
+    APPLIED = "applied"
+
+
+class RunJournal(SqliteStore):
+    """
+    Records the config, the notes and the state of every entry of a batch run.
+
+    Only the most recent run is kept around, since that's the only one that
+    can be resumed. State changes are buffered in memory and written in a single
+    transaction by `checkpoint()`, which is called every time a batch of notes
+    is committed. Only those unwritten changes are kept in memory, everything
+    else is looked up in the database, so a big run doesn't hold on to every
+    entry's URLs until it's done.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created REAL NOT NULL,
+        config TEXT NOT NULL,
+        note_ids TEXT NOT NULL,
+        finished INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS entries (
+        run_id INTEGER NOT NULL,
+        note_id INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        query TEXT NOT NULL,
+        state TEXT NOT NULL,
+        urls TEXT,
+        PRIMARY KEY (run_id, note_id, label, query)
+    );
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.run_id: Optional[int] = None
+        self._dirty: Dict[JournalKey, Tuple[str, Optional[List[str]]]] = {}
+
+    def start(self, config: dict, note_ids: List[int]) -> None:
+        """
+        Starts journaling a new run, forgetting about any previous ones.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.execute("DELETE FROM runs")
+            cursor = self._conn.execute(
+                "INSERT INTO runs (created, config, note_ids) VALUES (?, ?, ?)",
+                (time.time(), json.dumps(config), json.dumps(list(note_ids))))
+            self._conn.commit()
+            self.run_id = cursor.lastrowid
+            self._dirty = {}
+
+    def resume(self) -> Optional[Tuple[dict, List[int]]]:
+        """
+        Picks up the last run if it didn't finish. Returns its config and note
+        ids, or None if there's nothing to resume.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, config, note_ids FROM runs WHERE finished = 0 "
+                "ORDER BY id DESC LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.run_id = row[0]
+            self._dirty = {}
+            return json.loads(row[1]), json.loads(row[2])
+
+    def _entry(self, key: JournalKey) -> Optional[Tuple[str, Optional[List[str]]]]:
+        with self._lock:
+            entry = self._dirty.get(key)
+            if entry is not None:
+                return entry
+            row = self._conn.execute(
+                "SELECT state, urls FROM entries WHERE run_id = ? AND "
+                "note_id = ? AND label = ? AND query = ?",
+                (self.run_id,) + key).fetchone()
+        if row is None:
+            return None
+        state, urls = row
+        return state, json.loads(urls) if urls is not None else None
+
+    def state(self, key: JournalKey) -> str:
+        entry = self._entry(key)
+        return entry[0] if entry else JournalState.PENDING
+
+    def urls(self, key: JournalKey) -> Optional[List[str]]:
+        """
+        The image URLs found for the entry on an earlier attempt, if any.
+        """
+        entry = self._entry(key)
+        return entry[1] if entry else None
+
+    def mark(self, key: JournalKey, state: str,
+             urls: Optional[List[str]] = None) -> None:
+        """
+        Records a new state for the entry. Thread-safe. Nothing is written to
+        disk until the next checkpoint().
+        """
+        with self._lock:
+            # Nothing is looked up for an applied entry but its state.
+            if state == JournalState.APPLIED:
+                urls = None
+            elif urls is None:
+                urls = self.urls(key)
+            self._dirty[key] = (state, urls)
+
+    def checkpoint(self) -> None:
+        """
+        Writes all buffered state changes in one transaction.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries "
+                "(run_id, note_id, label, query, state, urls) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(self.run_id, note_id, label, query, state,
+                  json.dumps(urls) if urls is not None else None)
+                 for (note_id, label, query), (state, urls) in self._dirty.items()])
+            self._conn.commit()
+            self._dirty = {}
+
+    def finish(self) -> None:
+        """
+        Marks the run as done, so it won't be offered for resuming.
+        """
+        with self._lock:
+            self.checkpoint()
+            self._conn.execute(
+                "UPDATE runs SET finished = 1 WHERE id = ?", (self.run_id,))
+            self._conn.execute(
+                "DELETE FROM entries WHERE run_id = ?", (self.run_id,))
+            self._conn.commit()
@@ -0,0 +1,62 @@
+"""
+An index of the media files the add-on has written, by content, so that the
+same image isn't written to the collection more than once.
+"""
+import hashlib
+import os
+from typing import Dict
+from .store import SqliteStore
+
+
+class MediaIndex(SqliteStore):
+    """
+    Maps the SHA-1 of the (resized) image data to the media file that it was
+    written to.
+
+    Filenames come from the URL and query, so the same picture found through a
+    different query or on a mirror would otherwise be stored again under
+    another name. Since user_files is shared between profiles, entries are
+    kept per media folder.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS media (
+        media_dir TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        PRIMARY KEY (media_dir, hash)
+    );
+    """
+
+    def __init__(self, path: str, media_dir: str):
+        super().__init__(path)
+        self._media_dir = media_dir
+        self._filenames: Dict[str, str] = dict(self._conn.execute(
+            "SELECT hash, filename FROM media WHERE media_dir = ?",
+            (media_dir,)))
+        self.writes_saved = 0
+        self.bytes_saved = 0
+
+    def write_data(self, media, filename: str, data: bytes) -> str:
+        """
+        Like `media.write_data`, but if identical data was already written,
+        returns the existing file instead of writing it again.
+        """
+        content_hash = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            existing = self._filenames.get(content_hash)
+        # The file may have been deleted since, e.g. by Check Media.
+        if existing is not None and os.path.exists(
+                os.path.join(self._media_dir, existing)):
+            with self._lock:
+                self.writes_saved += 1
+                self.bytes_saved += len(data)
+            return existing
+
+        filename = media.write_data(filename, data)
+        with self._lock:
+            self._filenames[content_hash] = filename
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media (media_dir, hash, filename) "
+                "VALUES (?, ?, ?)", (self._media_dir, content_hash, filename))
+            self._conn.commit()
+        return filename
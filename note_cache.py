@@ -0,0 +1,97 @@
+"""
+Loads the notes for a run in bulk, and keeps one `Note` per id so that every
+query config's result is merged into the same object and written once.
+"""
+from typing import Dict, Iterator, List, Tuple
+from anki.collection import Collection
+from anki.notes import Note
+
+# Anki separates the fields in the `flds` column with this character.
+FIELD_SEPARATOR = "\x1f"
+
+
+class NoteCache:
+    """
+    Reading the source fields goes through `iter_fields`, which loads them
+    straight from the database in batches instead of one `get_note` at a time.
+
+    A `Note` is only loaded for notes that actually get images, the first time
+    one of its results is applied. Each note counts the results that are still
+    outstanding for it (see `expect` and `finish_result`), and it's only handed
+    back by `pop_finished` once all of them are in, so a note with several
+    query configs is written once instead of once per query config.
+    """
+    PREFETCH_BATCH_SIZE = 500
+
+    def __init__(self, col: Collection):
+        self._col = col
+        self._notes: Dict[int, Note] = {}
+        self._outstanding: Dict[int, int] = {}
+        # Field names by note type id.
+        self._field_names: Dict[int, List[str]] = {}
+
+    def iter_fields(self, note_ids: List[int]) -> Iterator[Tuple[int, Dict[str, str]]]:
+        """
+        Yields (note id, {field name: value}) for the given notes, in order.
+        Notes that don't exist (anymore) are skipped.
+        """
+        for start in range(0, len(note_ids), NoteCache.PREFETCH_BATCH_SIZE):
+            batch = note_ids[start:start + NoteCache.PREFETCH_BATCH_SIZE]
+            rows = self._col.db.all(
+                "SELECT id, mid, flds FROM notes WHERE id IN (%s)" %
+                ",".join(str(int(note_id)) for note_id in batch))
+            by_id = {note_id: (mid, flds) for note_id, mid, flds in rows}
+            for note_id in batch:
+                if note_id not in by_id:
+                    continue
+                mid, flds = by_id[note_id]
+                yield note_id, dict(zip(self._get_field_names(mid),
+                                        flds.split(FIELD_SEPARATOR)))
+
+    def _get_field_names(self, mid: int) -> List[str]:
+        if mid not in self._field_names:
+            model = self._col.models.get(mid)
+            self._field_names[mid] = [f["name"] for f in model["flds"]]
+        return self._field_names[mid]
+
+    def expect(self, note_id: int, num_results: int = 1) -> None:
+        """
+        Records that `num_results` more results are going to be applied to the
+        note.
+        """
+        self._outstanding[note_id] = self._outstanding.get(
+            note_id, 0) + num_results
+
+    def get_note(self, note_id: int) -> Note:
+        """
+        Returns the note to apply a result to, loading it the first time.
+        """
+        note = self._notes.get(note_id)
+        if note is None:
+            note = self._col.get_note(note_id)
+            self._notes[note_id] = note
+        return note
+
+    def finish_result(self, note_id: int) -> bool:
+        """
+        Records that one of the note's results was applied (or skipped).
+        Returns True if that was the last one, i.e. the note is done.
+        """
+        self._outstanding[note_id] -= 1
+        return self._outstanding[note_id] == 0
+
+    def pop_finished(self) -> Tuple[List[Note], List[int]]:
+        """
+        Returns the notes that were changed and are done, so they can be
+        written, along with the ids of every note that is done. They're
+        dropped from the cache.
+        """
+        finished_ids = [note_id for note_id, num in self._outstanding.items()
+                        if num == 0]
+        notes = []
+        for note_id in finished_ids:
+            del self._outstanding[note_id]
+            note = self._notes.pop(note_id, None)
+            if note is not None:
+                notes.append(note)
+        return notes, finished_ids
@@ -0,0 +1,80 @@
+"""
+Perceptual hashing, used to spot the same picture at different resolutions or
+on different mirrors.
+"""
+import io
+from typing import Dict, Optional
+from .store import SqliteStore
+
+# dHash compares each pixel of a (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail
+# to its right neighbour, giving HASH_SIZE * HASH_SIZE bits.
+HASH_SIZE = 8
+
+
+def dhash(img_data: bytes) -> Optional[int]:
+    """
+    Computes the difference hash of an image, or returns None if it can't be
+    decoded.
+    """
+    # Check README for why this import is here.
+    from PIL import Image
+    try:
+        im = Image.open(io.BytesIO(img_data))
+        # Decode JPEGs at a fraction of their size, the hash only needs a few
+        # pixels anyway.
+        im.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        im = im.convert("L").resize((HASH_SIZE + 1, HASH_SIZE),
+                                    Image.Resampling.BOX)
+    except Exception:
+        return None
+    pixels = list(im.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class PerceptualHashCache(SqliteStore):
+    """
+    Remembers the hash of the image at each URL, so that repeated runs don't
+    have to compute them again.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hashes (
+        url TEXT PRIMARY KEY,
+        hash TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # Hashes computed during this run, written out on close().
+        self._new_hashes: Dict[str, int] = {}
+
+    def get(self, url: str) -> Optional[int]:
+        with self._lock:
+            if url in self._new_hashes:
+                return self._new_hashes[url]
+            row = self._conn.execute("SELECT hash FROM hashes WHERE url = ?",
+                                     (url,)).fetchone()
+        # Stored as hex, since SQLite integers are signed 64 bit.
+        return int(row[0], 16) if row else None
+
+    def put(self, url: str, value: int) -> None:
+        with self._lock:
+            self._new_hashes[url] = value
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO hashes (url, hash) VALUES (?, ?)",
+                [(url, "%016x" % value)
+                 for url, value in self._new_hashes.items()])
+            super().close()
@@ -0,0 +1,714 @@
+"""
+The part of a run that doesn't need Anki's GUI: building the queries for the
+notes, scraping them, and writing the images to the collection.
+
+This is shared by the add-on (see gui.py) and the headless mode (see
+__main__.py).
+"""
+import concurrent.futures
+import multiprocessing
+import multiprocessing.util
+import os
+import signal
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from anki.collection import Collection
+from anki.notes import Note
+from .config_keys import ConfigDefaults, ConfigKeys, OverwriteValues
+from .scraper import QueryResult, BingScraper, DownloadLimits, strip_html_clozes
+from .search_cache import SearchCache
+from .dedup import QueryDeduplicator
+from .logging import logger
+from .store import user_files_path
+from .journal import JournalState, RunJournal
+from .domain_health import DomainScoreboard
+from .image_processing import ImageProcessor
+from .image_cache import ImageCache
+from .media_index import MediaIndex
+from .perceptual_hash import PerceptualHashCache
+from .note_cache import NoteCache
+from .instrumentation import Instrumentation, format_summary as format_instrumentation_summary
+from .scheduler import NoteScheduler, RunProgress, ThroughputMeter
+
+# Same as ThreadPoolExecutor's default.
+QUERY_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+class ProgressReporter:
+    """
+    Gets told how a run is going. This one ignores everything, see gui.py and
+    __main__.py for the real ones.
+    """
+
+    def message(self, label: str) -> None:
+        """
+        A status message, e.g. that Bing is throttling us. This can be called
+        from any thread.
+        """
+
+    def progress(self, progress: RunProgress) -> None:
+        """
+        Called regularly from the thread running the batch, with the notes
+        finished so far and how fast it's going.
+        """
+
+    def cancelled(self) -> bool:
+        """
+        Polled from the thread running the batch. Once this returns True, no
+        more queries are submitted, the ones that haven't started are dropped
+        and only the notes that are complete are written. The run is left
+        unfinished in the journal, so it can be resumed.
+        """
+        return False
+
+
+def query_results_for_note(note_id: int, note,
+                           config) -> List[QueryResult]:
+    """
+    One QueryResult per query config that needs to be scraped for the note.
+    `note` can be anything that maps field names to values.
+    """
+    source_value = note[config[ConfigKeys.SOURCE_FIELD]]
+    note_results = []
+
+    for qc in config[ConfigKeys.QUERY_CONFIGS]:
+        target_field = qc[ConfigKeys.TARGET_FIELD]
+
+        if not target_field or target_field == ConfigDefaults.IGNORED:
+            continue
+
+        # Process "Overwrite" config.
+        if note[target_field] and qc[ConfigKeys.OVERWRITE] == OverwriteValues.SKIP:
+            continue
+
+        final_search_query = qc[ConfigKeys.SEARCH_TERM].replace(
+            ConfigDefaults.WORD_PLACEHOLDER,
+            strip_html_clozes(source_value)
+        )
+
+        note_results.append(QueryResult(note_id=note_id,
+                          query=final_search_query,
+                          target_field=target_field,
+                          overwrite=qc[ConfigKeys.OVERWRITE],
+                          max_results=qc[ConfigKeys.RESULT_COUNT],
+                          width=qc[ConfigKeys.WIDTH],
+                          height=qc[ConfigKeys.HEIGHT],
+                          images=[],
+                          label=qc[ConfigKeys.LABEL],
+                          output_format=qc.get(
+                              ConfigKeys.OUTPUT_FORMAT,
+                              ConfigDefaults.OUTPUT_FORMAT),
+                          quality=qc.get(ConfigKeys.QUALITY,
+                                         ConfigDefaults.QUALITY)))
+    return note_results
+
+
+def build_note_queries(note_ids, config, note_cache: NoteCache
+                       ) -> Iterator[Tuple[int, List[QueryResult]]]:
+    """
+    Lazily generates (note id, results) with one QueryResult per query config
+    that needs to be scraped for the note.
+
+    The results are registered with `note_cache`, so that the note isn't
+    written until every one of them is applied.
+    """
+    for note_id, note in note_cache.iter_fields(note_ids):
+        note_results = query_results_for_note(note_id, note, config)
+        note_cache.expect(note_id, len(note_results))
+        yield note_id, note_results
+
+
+def open_journal() -> RunJournal:
+    return RunJournal(user_files_path("journal.sqlite3"))
+
+
+class ScraperStores:
+    """
+    The stores on disk that the scraper reads and writes.
+    """
+
+    def __init__(self, config):
+        self.search_cache = SearchCache(
+            user_files_path("search_cache.sqlite3"),
+            ttl_sec=config.get(ConfigKeys.SEARCH_CACHE_TTL_DAYS,
+                               ConfigDefaults.SEARCH_CACHE_TTL_DAYS) * 24 * 60 * 60,
+            max_entries=config.get(ConfigKeys.SEARCH_CACHE_MAX_ENTRIES,
+                                   ConfigDefaults.SEARCH_CACHE_MAX_ENTRIES))
+        self.domain_scoreboard = DomainScoreboard(
+            user_files_path("domain_health.sqlite3"))
+        self.image_cache = ImageCache(
+            user_files_path("image_cache.sqlite3"),
+            user_files_path("image_cache"),
+            max_bytes=config.get(ConfigKeys.IMAGE_CACHE_MAX_MB,
+                                 ConfigDefaults.IMAGE_CACHE_MAX_MB) * 1024 * 1024,
+            revalidate_after_sec=config.get(
+                ConfigKeys.IMAGE_CACHE_REVALIDATE_DAYS,
+                ConfigDefaults.IMAGE_CACHE_REVALIDATE_DAYS) * 24 * 60 * 60)
+        self.phash_cache = PerceptualHashCache(
+            user_files_path("perceptual_hashes.sqlite3"))
+
+    def close(self) -> None:
+        self.search_cache.close()
+        self.domain_scoreboard.close()
+        self.image_cache.close()
+        self.phash_cache.close()
+
+
+def make_instrumentation(config) -> Instrumentation:
+    enabled = config.get(ConfigKeys.INSTRUMENTATION,
+                         ConfigDefaults.INSTRUMENTATION)
+    return Instrumentation(enabled=enabled, trace=enabled)
+
+
+def make_download_limits(config) -> DownloadLimits:
+    return DownloadLimits(
+        max_bytes=config.get(ConfigKeys.MAX_IMAGE_BYTES,
+                             ConfigDefaults.MAX_IMAGE_BYTES),
+        max_pixels=config.get(ConfigKeys.MAX_IMAGE_PIXELS,
+                              ConfigDefaults.MAX_IMAGE_PIXELS),
+        min_pixels=config.get(ConfigKeys.MIN_IMAGE_PIXELS,
+                              ConfigDefaults.MIN_IMAGE_PIXELS))
+
+
+def make_scraper(config, executor: concurrent.futures.ThreadPoolExecutor,
+                 stores: ScraperStores, bypass_cache: bool,
+                 on_searched: Optional[Callable[[QueryResult, List[str]], None]],
+                 on_progress: Optional[Callable[[str], None]],
+                 instrumentation: Instrumentation) -> BingScraper:
+    return BingScraper(
+        executor, on_progress, stores.search_cache,
+        bypass_cache=bypass_cache,
+        search_concurrency=config.get(
+            ConfigKeys.SEARCH_CONCURRENCY,
+            ConfigDefaults.SEARCH_CONCURRENCY),
+        max_connections_per_host=config.get(
+            ConfigKeys.MAX_CONNECTIONS_PER_HOST,
+            ConfigDefaults.MAX_CONNECTIONS_PER_HOST),
+        search_rate=config.get(ConfigKeys.SEARCH_RATE,
+                               ConfigDefaults.SEARCH_RATE),
+        on_searched=on_searched,
+        domain_scoreboard=stores.domain_scoreboard,
+        image_processor=ImageProcessor(config.get(
+            ConfigKeys.IMAGE_PROCESS_WORKERS,
+            ConfigDefaults.IMAGE_PROCESS_WORKERS)),
+        download_limits=make_download_limits(config),
+        image_cache=stores.image_cache,
+        near_duplicate_threshold=config.get(
+            ConfigKeys.NEAR_DUPLICATE_THRESHOLD,
+            ConfigDefaults.NEAR_DUPLICATE_THRESHOLD),
+        phash_cache=stores.phash_cache,
+        convert_animated=config.get(ConfigKeys.CONVERT_ANIMATED,
+                                    ConfigDefaults.CONVERT_ANIMATED),
+        instrumentation=instrumentation)
+
+
+def scraper_stats(scraper: BingScraper,
+                  stores: ScraperStores) -> Dict[str, float]:
+    connection_stats = scraper.connection_stats
+    return {
+        "search_cache_hits": stores.search_cache.hits,
+        "search_cache_misses": stores.search_cache.misses,
+        "connections_opened": connection_stats.connections_opened,
+        "connections_reused": connection_stats.connections_reused,
+        "handshake_sec": connection_stats.handshake_sec,
+        "urls_skipped_on_failing_hosts": stores.domain_scoreboard.skipped,
+        "image_cache_hits": stores.image_cache.hits,
+        "image_cache_misses": stores.image_cache.misses,
+        "near_duplicates_skipped": scraper.near_duplicates_skipped,
+        "bytes_before_conversion": scraper.bytes_before_conversion,
+        "bytes_after_conversion": scraper.bytes_after_conversion,
+    }
+
+
+class ThreadedBackend:
+    """
+    Scrapes on threads in this process, one query per job.
+    """
+    # Every note is submitted right away.
+    shard_size = 1
+
+    def __init__(self, config, bypass_cache: bool, on_searched,
+                 reporter: ProgressReporter, instrumentation: Instrumentation):
+        self._stores = ScraperStores(config)
+        # One job = one query.
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=QUERY_WORKERS)
+        # Only set where the pool is. In a sharded run, the workers' pools are
+        # merged into the main process's instrumentation, which has none.
+        instrumentation.set_pool_size("query workers", QUERY_WORKERS)
+        self._scraper = make_scraper(config, self._executor, self._stores,
+                                     bypass_cache, on_searched,
+                                     reporter.message, instrumentation)
+
+    def submit(self, shard: List[QueryResult]
+               ) -> Dict[concurrent.futures.Future, List[QueryResult]]:
+        return {self._scraper.push_scrape_job(result): [result]
+                for result in shard}
+
+    def results_of(self, future: concurrent.futures.Future
+                   ) -> Tuple[List[QueryResult], List[QueryResult]]:
+        # A failed query raises here, see run_batch.
+        return [future.result()], []
+
+    def stats(self) -> Dict[str, float]:
+        return scraper_stats(self._scraper, self._stores)
+
+    def close(self) -> None:
+        # The jobs still running (e.g. after an error) use the scraper.
+        self._executor.shutdown()
+        self._scraper.close()
+        self._stores.close()
+
+
+class ShardedBackend:
+    """
+    Scrapes on worker processes, each of which has a scraper (and threads) of
+    its own, to use more than one core. The queries are sent to the workers in
+    shards, and the results come back to this process, which is the only one
+    that touches the collection and the journal.
+    """
+
+    def __init__(self, config, bypass_cache: bool, on_searched,
+                 num_workers: int, instrumentation: Instrumentation):
+        # Small enough that every worker has a shard queued up behind the one
+        # it's working on. Shards are made of whole notes, so they can be a
+        # little bigger.
+        self.shard_size = max(1, config.get(
+            ConfigKeys.MAX_QUERIES_IN_FLIGHT,
+            ConfigDefaults.MAX_QUERIES_IN_FLIGHT) // (2 * num_workers))
+        self._on_searched = on_searched
+        # Every worker has a rate limiter of its own, so they split the
+        # searches between them, to keep what Bing sees the same as with one
+        # process.
+        worker_config = dict(config)
+        worker_config[ConfigKeys.SEARCH_RATE] = config.get(
+            ConfigKeys.SEARCH_RATE, ConfigDefaults.SEARCH_RATE) / num_workers
+        worker_config[ConfigKeys.SEARCH_CONCURRENCY] = max(1, config.get(
+            ConfigKeys.SEARCH_CONCURRENCY,
+            ConfigDefaults.SEARCH_CONCURRENCY) // num_workers)
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(worker_config, bypass_cache))
+        # The latest stats and instrumentation from each worker, by pid.
+        # They're running totals.
+        self._worker_stats: Dict[int, Dict[str, float]] = {}
+        self._worker_instrumentation: Dict[int, dict] = {}
+        self._instrumentation = instrumentation
+
+    def submit(self, shard: List[QueryResult]
+               ) -> Dict[concurrent.futures.Future, List[QueryResult]]:
+        return {self._pool.submit(_scrape_shard, shard): shard}
+
+    def results_of(self, future: concurrent.futures.Future
+                   ) -> Tuple[List[QueryResult], List[QueryResult]]:
+        """
+        Returns the shard's (scraped results, failed results).
+        """
+        results, failed, pid, stats, instrumentation = future.result()
+        self._worker_stats[pid] = stats
+        self._instrumentation.add_trace_events(
+            instrumentation.pop("trace_events"))
+        self._worker_instrumentation[pid] = instrumentation
+        if self._on_searched is not None:
+            for result in results:
+                self._on_searched(result, result.image_urls)
+        return results, failed
+
+    def stats(self) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for stats in self._worker_stats.values():
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def close(self) -> None:
+        self._pool.shutdown()
+        for instrumentation in self._worker_instrumentation.values():
+            self._instrumentation.merge(instrumentation)
+
+
+class _Worker:
+    """
+    The scraper of a worker process, see ShardedBackend.
+    """
+
+    def __init__(self, config, bypass_cache: bool):
+        self.stores = ScraperStores(config)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=QUERY_WORKERS)
+        self.instrumentation = make_instrumentation(config)
+        self.instrumentation.set_pool_size("query workers", QUERY_WORKERS)
+        # The image URLs found for each result of the shard being scraped, by
+        # id(), to be sent back along with the results.
+        self.image_urls: Dict[int, List[str]] = {}
+        self.scraper = make_scraper(config, self.executor, self.stores,
+                                    bypass_cache, self._on_searched, None,
+                                    self.instrumentation)
+
+    def _on_searched(self, result: QueryResult, image_urls: List[str]) -> None:
+        self.image_urls[id(result)] = image_urls
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.scraper.close()
+        self.stores.close()
+
+
+_worker: Optional[_Worker] = None
+
+
+def _init_worker(config, bypass_cache: bool) -> None:
+    global _worker
+    # Ctrl-C goes to the whole process group, but it's up to the main process
+    # what happens then (see ProgressReporter.cancelled).
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker = _Worker(config, bypass_cache)
+    # The pool has no hook for when a worker is done, but finalizers are run
+    # when a worker process exits. The stores only write some things on close.
+    multiprocessing.util.Finalize(_worker, _worker.close, exitpriority=10)
+
+
+def _scrape_shard(shard: List[QueryResult]):
+    futures = [_worker.scraper.push_scrape_job(result) for result in shard]
+    results = []
+    # One failed query shouldn't take the rest of the shard down with it.
+    failed = []
+    for result, future in zip(shard, futures):
+        try:
+            scraped = future.result()
+        except Exception as e:
+            logger.exception(e)
+            failed.append(result)
+            continue
+        image_urls = _worker.image_urls.pop(id(scraped), scraped.image_urls)
+        results.append(scraped._replace(image_urls=image_urls))
+    return (results, failed, os.getpid(),
+            scraper_stats(_worker.scraper, _worker.stores),
+            _worker.instrumentation.snapshot())
+
+
+def run_batch(col: Collection, config, note_ids, bypass_cache: bool,
+              journal: RunJournal,
+              reporter: ProgressReporter = ProgressReporter(),
+              num_workers: int = 0) -> Dict[str, float]:
+    """
+    Scrapes images for the notes with the given config and writes them to the
+    collection.
+
+    With `num_workers` > 0, the scraping is sharded across that many worker
+    processes. Otherwise it runs on threads in this process.
+
+    The run can be cancelled through `reporter`, see
+    ProgressReporter.cancelled.
+
+    Returns the stats for the summary, see `format_summary`.
+    """
+    instrumentation = make_instrumentation(config)
+    media_index = MediaIndex(user_files_path("media_index.sqlite3"),
+                             col.media.dir())
+    # Nothing would ever be submitted with less than one.
+    max_in_flight = max(1, config.get(ConfigKeys.MAX_QUERIES_IN_FLIGHT,
+                                      ConfigDefaults.MAX_QUERIES_IN_FLIGHT))
+    commit_batch_size = config.get(ConfigKeys.COMMIT_BATCH_SIZE,
+                                   ConfigDefaults.COMMIT_BATCH_SIZE)
+
+    # Notes are written in batches as results come in, so that a crash late in
+    # the run doesn't lose everything. Every batch is merged into this one undo
+    # entry, so the whole run can still be undone in one step:
+    # https://forums.ankiweb.net/t/anki-2-1-45-beta/10664/121
+    undo_entry = col.add_custom_undo_entry("Add images")
+    note_cache = NoteCache(col)
+    # The journal entries that were applied to notes that aren't written yet,
+    # by note id. They're marked as applied once their note is written.
+    updated_keys: Dict[int, List] = {}
+    # Notes that are done and have something to write, but aren't written yet.
+    num_unflushed = 0
+    num_failed = 0
+    meter = ThroughputMeter(len(note_ids))
+
+    def journal_key(result: QueryResult):
+        return (result.note_id, result.label, result.query)
+
+    def on_searched(result: QueryResult, image_urls: List[str]):
+        journal.mark(journal_key(result), JournalState.SEARCHED, image_urls)
+
+    def finish_result(note_id: int):
+        nonlocal num_unflushed
+        if note_cache.finish_result(note_id):
+            meter.add_note()
+            if note_id in updated_keys:
+                num_unflushed += 1
+
+    def apply_result(result: QueryResult):
+        journal.mark(journal_key(result), JournalState.DOWNLOADED)
+        apply_result_to_note(col, result, media_index=media_index,
+                             note_cache=note_cache,
+                             instrumentation=instrumentation)
+        meter.add_bytes(sum(len(data) for _, data in result.images))
+        updated_keys.setdefault(result.note_id, []).append(journal_key(result))
+        finish_result(result.note_id)
+
+    def fail_result(result: QueryResult):
+        nonlocal num_failed
+        # The rest of the note is still written. This query is left as it is
+        # in the journal, so that resuming the run tries it again.
+        num_failed += 1
+        finish_result(result.note_id)
+
+    def notes_to_scrape():
+        """
+        The queries that still need to be scraped, by note. When resuming,
+        what's already done is skipped, and the image URLs that were already
+        found are reused.
+        """
+        for note_id, note_results in build_note_queries(note_ids, config,
+                                                        note_cache):
+            if not note_results:
+                meter.add_note()
+                continue
+            remaining = []
+            for result in note_results:
+                state = journal.state(journal_key(result))
+                if state == JournalState.APPLIED:
+                    finish_result(note_id)
+                    continue
+                if state != JournalState.PENDING:
+                    result = result._replace(
+                        image_urls=journal.urls(journal_key(result)))
+                remaining.append(result)
+            if remaining:
+                yield note_id, remaining
+
+    def flush_updated_notes():
+        nonlocal num_unflushed
+        # Only notes that have all of their results are written, so each note
+        # is written once.
+        notes, finished_ids = note_cache.pop_finished()
+        if notes:
+            with instrumentation.span("update_notes"):
+                col.update_notes(notes)
+                col.merge_undo_entries(undo_entry)
+        for note_id in finished_ids:
+            for key in updated_keys.pop(note_id, []):
+                journal.mark(key, JournalState.APPLIED)
+        num_unflushed = 0
+        journal.checkpoint()
+
+    if num_workers > 0:
+        backend = ShardedBackend(config, bypass_cache, on_searched,
+                                 num_workers, instrumentation)
+    else:
+        backend = ThreadedBackend(config, bypass_cache, on_searched, reporter,
+                                  instrumentation)
+    dedup = QueryDeduplicator()
+    scheduler = NoteScheduler(notes_to_scrape(), lookahead=max_in_flight)
+    # The futures that aren't done yet, with the queries each one is for.
+    pending: Dict[concurrent.futures.Future, List[QueryResult]] = {}
+    # Results waiting to be sent off as a shard.
+    shard: List[QueryResult] = []
+    num_in_flight = 0
+    exhausted = False
+    stopped = False
+    # Only if something was actually left undone.
+    cancelled = False
+
+    def submit_shard():
+        nonlocal shard, num_in_flight
+        pending.update(backend.submit(shard))
+        num_in_flight += len(shard)
+        shard = []
+
+    finished = False
+    try:
+        while pending or shard or not exhausted:
+            if not stopped and reporter.cancelled():
+                stopped = exhausted = True
+                # Whatever is already running is let finish, so that its notes
+                # can still be completed.
+                dropped = [future for future in pending if future.cancel()]
+                cancelled = bool(shard or dropped or
+                                 scheduler.next_note() is not None)
+                shard = []
+
+            # Keep at most `max_in_flight` queries submitted at a time, so that
+            # the memory used by downloaded images stays flat no matter how
+            # many notes there are. A note's queries all go out together, so
+            # this can be overshot by one note.
+            while not exhausted and num_in_flight + len(shard) < max_in_flight:
+                note = scheduler.next_note()
+                if note is None:
+                    exhausted = True
+                    break
+                for result in note[1]:
+                    # Identical queries (e.g. the same word on two notes) are
+                    # only scraped once, see the fan out below.
+                    ready = dedup.completed(result)
+                    if ready is not None:
+                        apply_result(ready)
+                    elif dedup.add(result):
+                        shard.append(result)
+                if len(shard) >= backend.shard_size:
+                    submit_shard()
+            # Don't hold on to a partial shard when there's nothing else going
+            # on.
+            if shard and (exhausted or not pending):
+                submit_shard()
+
+            # Poll instead of blocking on as_completed so that the caller gets
+            # to report progress (and keep the UI responsive).
+            done, _ = concurrent.futures.wait(
+                pending, timeout=0.1,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                submitted = pending.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    scraped_results, failed_results = backend.results_of(future)
+                except Exception as e:
+                    # e.g. the search ran out of retries, or a worker process
+                    # died. The rest of the run goes on.
+                    logger.exception(e)
+                    scraped_results, failed_results = [], submitted
+                for scraped in scraped_results:
+                    num_in_flight -= 1
+                    for result in dedup.fan_out(scraped):
+                        apply_result(result)
+                for failed in failed_results:
+                    num_in_flight -= 1
+                    for result in dedup.drop(failed):
+                        fail_result(result)
+
+            instrumentation.sample("queries in flight", num_in_flight)
+            if num_unflushed >= commit_batch_size:
+                flush_updated_notes()
+            reporter.progress(meter.progress())
+        finished = True
+    finally:
+        for future in pending:
+            future.cancel()
+        backend.close()
+        try:
+            flush_updated_notes()
+            # Failed queries are left unfinished, so that resuming the run
+            # tries them again.
+            if finished and not cancelled and not num_failed:
+                journal.finish()
+        finally:
+            journal.close()
+            media_index.close()
+
+    stats = backend.stats()
+    stats.update({
+        "notes_processed": len(note_ids),
+        "notes_completed": meter.notes_completed,
+        "cancelled": cancelled,
+        "queries_failed": num_failed,
+        "duplicate_queries_skipped": dedup.saved,
+        "media_writes_saved": media_index.writes_saved,
+        "media_bytes_saved": media_index.bytes_saved,
+    })
+    if instrumentation.enabled:
+        stats["instrumentation"] = instrumentation.to_dict()
+        # e.g. user_files/instrumentation/2024-01-31-120000.json
+        path = user_files_path("instrumentation",
+                               time.strftime("%Y-%m-%d-%H%M%S"))
+        instrumentation.export_json(path + ".json")
+        instrumentation.export_chrome_trace(path + ".trace.json")
+        stats["instrumentation_report"] = path + ".json"
+    return stats
+
+
+def format_summary(stats: Dict[str, float]) -> str:
+    """
+    The stats from `run_batch`, for people.
+    """
+    summary = ""
+    if stats.get("cancelled"):
+        summary = ("Cancelled with %d of %d notes done. Resume the run to do "
+                   "the rest.\n\n" % (stats["notes_completed"],
+                                       stats["notes_processed"]))
+    elif stats.get("queries_failed"):
+        summary = ("%d queries failed, see the log. Resume the run to try "
+                   "them again.\n\n" % stats["queries_failed"])
+    summary += ("Number of notes processed: %d\n"
+            "Duplicate queries skipped: %d\n"
+            "Search cache: %d hits, %d misses\n"
+            "Connections: %d opened, %d reused, %.1fs in handshakes\n"
+            "Image URLs skipped on failing hosts: %d\n"
+            "Image cache: %d hits, %d misses\n"
+            "Duplicate media files not written: %d (%.1f MB saved)\n"
+            "Near-duplicate images skipped: %d\n"
+            "Image bytes: %.1f MB before conversion, %.1f MB after" %
+            (stats["notes_processed"], stats["duplicate_queries_skipped"],
+             stats.get("search_cache_hits", 0),
+             stats.get("search_cache_misses", 0),
+             stats.get("connections_opened", 0),
+             stats.get("connections_reused", 0),
+             stats.get("handshake_sec", 0),
+             stats.get("urls_skipped_on_failing_hosts", 0),
+             stats.get("image_cache_hits", 0),
+             stats.get("image_cache_misses", 0),
+             stats["media_writes_saved"],
+             stats["media_bytes_saved"] / 1024 / 1024,
+             stats.get("near_duplicates_skipped", 0),
+             stats.get("bytes_before_conversion", 0) / 1024 / 1024,
+             stats.get("bytes_after_conversion", 0) / 1024 / 1024))
+    if "instrumentation" in stats:
+        summary += "\n\n%s\n\nReport and trace: %s" % (
+            format_instrumentation_summary(stats["instrumentation"]),
+            stats["instrumentation_report"])
+    return summary
+
+
+def apply_result_to_note(col: Collection, result: QueryResult, delimiter=" ",
+                         media_index: Optional[MediaIndex] = None,
+                         note_cache: Optional[NoteCache] = None,
+                         instrumentation: Instrumentation = Instrumentation()) -> Note:
+    """
+    Given a QueryResult, mutates a note using the information in the result.
+
+    `delimiter` was a param in the old codebase, not really configurable for
+    now.
+
+    If a `media_index` is given, images that are already in the media folder
+    (by content) aren't written again.
+
+    If a `note_cache` is given, the note comes from there, so that the results
+    for all of a note's query configs end up in the same Note object.
+
+    This returns the note but does NOT persist it to the database immediately.
+    Returns None if there were no images.
+    """
+    if not result.images:
+        return
+    new_note_html = []
+    for fname, data in result.images:
+        with instrumentation.span("media_write") as span:
+            written = True
+            if media_index is not None:
+                writes_saved = media_index.writes_saved
+                fname = media_index.write_data(col.media, fname, data)
+                written = media_index.writes_saved == writes_saved
+            else:
+                fname = col.media.write_data(fname, data)
+            # A deduplicated write only looked up the existing file.
+            if written:
+                span.num_bytes = len(data)
+        filename = '<img src="%s">' % fname
+        new_note_html.append(filename)
+    if note_cache is not None:
+        note = note_cache.get_note(result.note_id)
+    else:
+        note = col.get_note(result.note_id)
+
+    assert (result.overwrite != OverwriteValues.SKIP)
+    if result.overwrite == OverwriteValues.APPEND:
+        if note[result.target_field]:
+            note[result.target_field] += delimiter
+        note[result.target_field] += delimiter.join(new_note_html)
+    else:
+        note[result.target_field] = delimiter.join(new_note_html)
+    return note
@@ -0,0 +1,126 @@
+"""
+Warms the caches in the background for notes as they're added, so that a later
+"Add images" run over them is served from the search and image caches instead
+of the network.
+"""
+import collections
+import threading
+from typing import Deque
+
+from .config_keys import ConfigKeys
+from .logging import logger
+from .pipeline import ScraperStores, make_download_limits, query_results_for_note
+from .rate_limit import BandwidthLimiter
+from .scraper import BingScraper, QueryResult
+
+
+class Prefetcher:
+    """
+    Stays out of the way of everything else: `num_threads` threads do one
+    download at a time each, reading at most `max_bytes_per_sec` between them,
+    and searches go out much slower than in a run. While a run is going in the
+    foreground, everything stops (see `pause`).
+    """
+    # Once this many queries are waiting, new ones are dropped.
+    MAX_QUEUED = 1000
+    # Searches per second.
+    SEARCH_RATE = 0.5
+    # How long `close` waits for each thread to stop. Everything they do is
+    # cancelled first, so they only have to get out of a blocking read.
+    CLOSE_TIMEOUT_SEC = 1
+
+    def __init__(self, config, num_threads: int, max_bytes_per_sec: float):
+        self._stores = ScraperStores(config)
+        # Jobs never get pushed onto an executor, so there's no executor.
+        self._scraper = BingScraper(
+            None,
+            search_cache=self._stores.search_cache,
+            search_concurrency=num_threads,
+            search_rate=Prefetcher.SEARCH_RATE,
+            domain_scoreboard=self._stores.domain_scoreboard,
+            download_limits=make_download_limits(config),
+            image_cache=self._stores.image_cache,
+            bandwidth_limiter=BandwidthLimiter(max_bytes_per_sec))
+        self._cond = threading.Condition()
+        self._queue: Deque[QueryResult] = collections.deque()
+        self._paused = False
+        self._closed = False
+        # Set to stop the downloads in progress, see `pause`.
+        self._cancelled = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name="faws-prefetch",
+                             daemon=True)
+            for _ in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def add_note(self, note_id: int, note, config) -> None:
+        """
+        Queues up the queries for the note (anything that maps field names to
+        values), using the query configs in `config`.
+        """
+        if config[ConfigKeys.SOURCE_FIELD] not in note:
+            return
+        # The saved query configs are for whichever note type was used last,
+        # this note's type might not have the same fields.
+        config = dict(config)
+        config[ConfigKeys.QUERY_CONFIGS] = [
+            qc for qc in config[ConfigKeys.QUERY_CONFIGS]
+            if qc[ConfigKeys.TARGET_FIELD] in note]
+        results = query_results_for_note(note_id, note, config)
+        with self._cond:
+            for result in results:
+                if len(self._queue) < Prefetcher.MAX_QUEUED:
+                    self._queue.append(result)
+            self._cond.notify_all()
+
+    def pause(self) -> None:
+        """
+        Stops prefetching until `resume`, abandoning the searches and downloads
+        in progress (their queries are tried again later).
+        """
+        with self._cond:
+            self._paused = True
+            self._cancelled.set()
+
+    def resume(self) -> None:
+        with self._cond:
+            self._paused = False
+            self._cancelled = threading.Event()
+            self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed and (self._paused or not self._queue):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                result = self._queue.popleft()
+                cancelled = self._cancelled
+            try:
+                done = self._scraper.prefetch(result, cancelled)
+            except Exception as e:
+                # e.g. the search ran out of retries. It's only a prefetch.
+                logger.exception(e)
+                continue
+            if not done:
+                with self._cond:
+                    self._queue.appendleft(result)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cancelled.set()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(Prefetcher.CLOSE_TIMEOUT_SEC)
+        if any(thread.is_alive() for thread in self._threads):
+            # Closing the stores under a thread that's still using them would
+            # break it, or lose what it writes. They're left for the process
+            # exit instead.
+            logger.debug("Prefetch threads didn't stop, leaving the stores "
+                         "open")
+            return
+        self._scraper.close()
+        self._stores.close()
@@ -0,0 +1,171 @@
+"""
+Rate limiting that is shared between all of the jobs talking to the same server.
+"""
+import email.utils
+import random
+import threading
+import time
+from typing import Optional
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header, which is either a number of seconds or an HTTP
+    date, into a number of seconds from now.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, base_sec: float, cap_sec: float) -> float:
+    """
+    Exponential backoff with "full jitter", so that jobs that failed at the same
+    time don't all retry at the same time.
+    """
+    return random.uniform(0, min(cap_sec, base_sec * (2 ** attempt)))
+
+
+class AdaptiveRateLimiter:
+    """
+    A token bucket combined with a concurrency limit, both of which adapt
+    AIMD-style (additive increase, multiplicative decrease): every success nudges
+    the rate and concurrency up a little, every 429 or timeout cuts them.
+
+    A single instance is shared by all jobs, so one job getting throttled slows
+    everyone down instead of the others carrying on at full speed.
+    """
+    # Don't cut the rate more than once per this many seconds. A burst of
+    # requests that were all in flight when the server started throttling
+    # will fail together, but that's one signal, not many.
+    DECREASE_COOLDOWN_SEC = 1.0
+    # How often a cancellable acquire() checks whether it was cancelled.
+    CANCEL_POLL_SEC = 0.1
+
+    def __init__(self, rate: float, max_concurrency: int,
+                 min_rate: float = 0.2, max_rate: Optional[float] = None,
+                 increase_step: float = 0.1, decrease_factor: float = 0.5):
+        self._cond = threading.Condition()
+        self._min_rate = min_rate
+        self._max_rate = max_rate if max_rate is not None else rate * 4
+        self._rate = rate
+        self._increase_step = increase_step
+        self._decrease_factor = decrease_factor
+        self._max_concurrency = max(1, max_concurrency)
+        self._concurrency = float(self._max_concurrency)
+        self._in_flight = 0
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        # Set from Retry-After. Nobody gets a token until then.
+        self._blocked_until = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @property
+    def concurrency(self) -> int:
+        return int(self._concurrency)
+
+    def _refill(self, now: float) -> None:
+        # Allow a burst of up to one second's worth of requests.
+        burst = max(1.0, self._rate)
+        self._tokens = min(burst,
+                           self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def acquire(self, cancelled: Optional[threading.Event] = None) -> bool:
+        """
+        Blocks until a request is allowed to go out. Every acquire() that
+        returns True has to be followed by a release().
+
+        Returns False without a slot if `cancelled` gets set while waiting.
+        """
+        def wait(timeout: Optional[float]) -> None:
+            if cancelled is not None:
+                timeout = min(timeout or AdaptiveRateLimiter.CANCEL_POLL_SEC,
+                              AdaptiveRateLimiter.CANCEL_POLL_SEC)
+            self._cond.wait(timeout)
+
+        with self._cond:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait(self._blocked_until - now)
+                elif self._in_flight >= int(self._concurrency):
+                    wait(None)
+                elif self._tokens < 1:
+                    wait((1 - self._tokens) / self._rate)
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return True
+
+    def release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        with self._cond:
+            self._rate = min(self._max_rate, self._rate + self._increase_step)
+            # Grows by about one per "window" of requests, like TCP.
+            self._concurrency = min(self._max_concurrency,
+                                    self._concurrency + 1 / self._concurrency)
+            self._cond.notify_all()
+
+    def on_throttle(self, retry_after_sec: Optional[float] = None) -> None:
+        """
+        Called on a 429 (or a timeout, which usually means the same thing).
+        """
+        with self._cond:
+            now = time.monotonic()
+            if retry_after_sec:
+                self._blocked_until = max(self._blocked_until,
+                                          now + retry_after_sec)
+            if now - self._last_decrease >= AdaptiveRateLimiter.DECREASE_COOLDOWN_SEC:
+                self._last_decrease = now
+                self._rate = max(self._min_rate,
+                                 self._rate * self._decrease_factor)
+                self._concurrency = max(1.0,
+                                        self._concurrency * self._decrease_factor)
+            self._cond.notify_all()
+
+
+class BandwidthLimiter:
+    """
+    Keeps the bytes read by all of the threads sharing it under
+    `bytes_per_sec` on average, allowing bursts of up to a second's worth.
+    """
+
+    def __init__(self, bytes_per_sec: float):
+        self._lock = threading.Lock()
+        self._bytes_per_sec = bytes_per_sec
+        self._tokens = bytes_per_sec
+        self._last_refill = time.monotonic()
+
+    def consume(self, num_bytes: int) -> None:
+        """
+        Call after reading `num_bytes`. Sleeps if that went over the limit.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._bytes_per_sec,
+                self._tokens + (now - self._last_refill) * self._bytes_per_sec)
+            self._last_refill = now
+            self._tokens -= num_bytes
+            delay = -self._tokens / self._bytes_per_sec
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,119 @@
+"""
+Decides which notes' queries go out next in a run, and keeps track of how fast
+notes are getting done.
+"""
+import heapq
+import time
+from collections import deque
+from typing import Deque, Iterator, List, NamedTuple, Optional, Tuple
+
+from .scraper import QueryResult
+
+
+class NoteScheduler:
+    """
+    Hands out the queries a note at a time, so that all of a note's query
+    configs are scraped together and the note can be written as soon as
+    they're in, instead of its queries finishing all over the run.
+
+    Out of the next `lookahead` notes, the ones with the fewest queries left go
+    first, e.g. a note that's half done from an interrupted run, or one whose
+    other fields are skipped since they're already filled. Each query that a
+    note still needs counts as `QUERY_COST` notes of waiting, so a note with
+    more queries is only ever passed over by a few later notes.
+    """
+    QUERY_COST = 4
+
+    def __init__(self, notes: Iterator[Tuple[int, List[QueryResult]]],
+                 lookahead: int):
+        self._notes = notes
+        self._lookahead = lookahead
+        # (priority, arrival, note id, results)
+        self._heap: List[Tuple[int, int, int, List[QueryResult]]] = []
+        self._num_arrived = 0
+        self._exhausted = False
+
+    def next_note(self) -> Optional[Tuple[int, List[QueryResult]]]:
+        """
+        Returns (note id, the note's queries) for the note to submit next, or
+        None once there are no notes left.
+        """
+        while not self._exhausted and len(self._heap) < self._lookahead:
+            note = next(self._notes, None)
+            if note is None:
+                self._exhausted = True
+                break
+            note_id, results = note
+            priority = self._num_arrived + NoteScheduler.QUERY_COST * len(results)
+            heapq.heappush(self._heap,
+                           (priority, self._num_arrived, note_id, results))
+            self._num_arrived += 1
+        if not self._heap:
+            return None
+        _, _, note_id, results = heapq.heappop(self._heap)
+        return note_id, results
+
+
+class RunProgress(NamedTuple):
+    notes_completed: int
+    notes_total: int
+    notes_per_sec: float
+    # Of the images that were added to notes.
+    bytes_per_sec: float
+    # None until there's a rate to go by.
+    eta_sec: Optional[float]
+
+
+class ThroughputMeter:
+    """
+    Counts the notes that are done and the image bytes that went into them.
+    The rates are over the last `window_sec`, so that the ETA follows the run
+    when it slows down, e.g. when Bing starts throttling.
+    """
+    WINDOW_SEC = 30
+
+    def __init__(self, notes_total: int, window_sec: float = WINDOW_SEC):
+        self.notes_total = notes_total
+        self.notes_completed = 0
+        self.bytes_completed = 0
+        self._window_sec = window_sec
+        # (time, notes completed, bytes completed)
+        self._samples: Deque[Tuple[float, int, int]] = deque(
+            [(time.monotonic(), 0, 0)])
+
+    def add_note(self) -> None:
+        self.notes_completed += 1
+
+    def add_bytes(self, num_bytes: int) -> None:
+        self.bytes_completed += num_bytes
+
+    def progress(self) -> RunProgress:
+        now = time.monotonic()
+        self._samples.append((now, self.notes_completed, self.bytes_completed))
+        while (len(self._samples) > 2 and
+               now - self._samples[1][0] >= self._window_sec):
+            self._samples.popleft()
+        start, notes_at_start, bytes_at_start = self._samples[0]
+        elapsed = now - start
+        notes_per_sec = bytes_per_sec = 0.0
+        if elapsed > 0:
+            notes_per_sec = (self.notes_completed - notes_at_start) / elapsed
+            bytes_per_sec = (self.bytes_completed - bytes_at_start) / elapsed
+        eta_sec = None
+        if notes_per_sec > 0:
+            eta_sec = max(0, self.notes_total - self.notes_completed) / notes_per_sec
+        return RunProgress(self.notes_completed, self.notes_total,
+                           notes_per_sec, bytes_per_sec, eta_sec)
+
+
+def format_progress(progress: RunProgress) -> str:
+    """
+    e.g. "Finished 120 of 500 notes (3.2 notes/s, 1.4 MB/s), about 1:58 left"
+    """
+    label = "Finished %d of %d notes (%.1f notes/s, %.1f MB/s)" % (
+        progress.notes_completed, progress.notes_total,
+        progress.notes_per_sec, progress.bytes_per_sec / 1024 / 1024)
+    if progress.eta_sec is not None:
+        minutes, seconds = divmod(int(progress.eta_sec), 60)
+        label += ", about %d:%02d left" % (minutes, seconds)
+    return label
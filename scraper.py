@@ -1,15 +1,25 @@
 """
 Helper functions related to scraping images.
 """
-from aqt.qt import QApplication
-from typing import NamedTuple, List, Tuple
-import io
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple, List, Optional, Tuple
 import re
+import tempfile
+import threading
+import time
 import requests
 from bs4 import BeautifulSoup
 import concurrent.futures
 from anki.utils import checksum
 from .logging import logger
+from .search_cache import SearchCache
+from .session_pool import SessionPool
+from .domain_health import DomainScoreboard
+from .image_cache import ImageCache
+from .config_keys import OutputFormatValues
+from .image_processing import ImageProcessor, sniff_image_size
+from .perceptual_hash import PerceptualHashCache, dhash, hamming_distance
+from .rate_limit import AdaptiveRateLimiter, BandwidthLimiter, backoff_delay, parse_retry_after
+from .instrumentation import Instrumentation
 
 
 class QueryResult(NamedTuple):
@@ -26,16 +36,39 @@ class QueryResult(NamedTuple):
     height: int
     # (filename, image data)
     images: List[Tuple[str, bytes]]
+    # The label of the query config this came from.
+    label: str = ""
+    # If the image URLs are already known (e.g. when resuming a run), the search
+    # is skipped.
+    image_urls: Optional[List[str]] = None
+    # See OutputFormatValues.
+    output_format: str = OutputFormatValues.ORIGINAL
+    quality: int = 80
 
 
-def sleep(seconds):
+class HostOutcome:
     """
-    Sleep for a certain amount of time to throttle request rates.
+    What fetching an image says about its host, for the domain scoreboard.
     """
-    start = time.time()
-    while time.time() - start < seconds:
-        time.sleep(0.01)
-        QApplication.instance().processEvents()
+    # It was downloaded.
+    OK = "ok"
+    # A connection error, a timeout or an HTTP error.
+    FAILED = "failed"
+    # Nothing, e.g. the image was turned down by the download limits or
+    # wasn't an image at all, which isn't the host's fault, or it came from the
+    # image cache (possibly after a 304).
+    NONE = "none"
+
+
+class DownloadLimits(NamedTuple):
+    """
+    Images outside of these limits are abandoned as soon as that's known,
+    usually after the first chunk of the download.
+    """
+    max_bytes: int = 20 * 1024 * 1024
+    # Width * height.
+    max_pixels: int = 50 * 1000 * 1000
+    min_pixels: int = 50 * 50
 
 
 def strip_html_clozes(w: str) -> str:
@@ -66,6 +99,45 @@ def strip_html_clozes(w: str) -> str:
     return w
 
 
+class UrlExtractor:
+    """
+    Finds the matches of a regex in a document that arrives in chunks, such as a
+    streamed response. Matches that span chunks are handled.
+
+    `prefix` is the literal text that every match starts with. It's used to
+    tell which part of the unmatched text could still become a match.
+    """
+    # If a match is started but not finished within this many bytes, it's
+    # never going to be.
+    MAX_PENDING_BYTES = 64 * 1024
+
+    def __init__(self, regex: str, prefix: str):
+        self._regex = re.compile(regex.encode())
+        self._prefix = prefix.encode()
+        self._buffer = b""
+
+    def feed(self, chunk: bytes) -> List[str]:
+        """
+        Adds the next chunk and returns the (first group of the) matches that
+        were completed by it.
+        """
+        self._buffer += chunk
+        matches = []
+        end = 0
+        for match in self._regex.finditer(self._buffer):
+            matches.append(match.group(1).decode("utf-8", "replace"))
+            end = match.end()
+        rest = self._buffer[end:]
+
+        # Only keep what could still turn into a match: from an unfinished
+        # match onwards, or else the tail that could be the start of the prefix.
+        start = rest.find(self._prefix)
+        if start == -1 or len(rest) - start > UrlExtractor.MAX_PENDING_BYTES:
+            start = max(0, len(rest) - len(self._prefix) + 1)
+        self._buffer = rest[start:]
+        return matches
+
+
 class Scraper:
     # Taken from the source code of bing-image-downloader (Python)
     # Note: It's actually really important that these headers have certain
@@ -76,10 +148,94 @@ class Scraper:
     # the problem.
     SPOOFED_HEADER = {
         'User-Agent': 'Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0'}
-
-    def __init__(self, executor: concurrent.futures.ThreadPoolExecutor, mw):
+    # How many image URLs to search for beyond the number of results needed,
+    # for the candidates that fail. Searches stop reading the results there.
+    SEARCH_HEADROOM = 15
+
+    def __init__(self, executor: concurrent.futures.ThreadPoolExecutor,
+                 on_progress: Optional[Callable[[str], None]] = None,
+                 search_cache: Optional[SearchCache] = None,
+                 bypass_cache: bool = False,
+                 max_connections_per_host: int = SessionPool.DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 on_searched: Optional[Callable[[QueryResult, List[str]], None]] = None,
+                 domain_scoreboard: Optional[DomainScoreboard] = None,
+                 image_processor: Optional[ImageProcessor] = None,
+                 download_limits: DownloadLimits = DownloadLimits(),
+                 image_cache: Optional[ImageCache] = None,
+                 near_duplicate_threshold: int = -1,
+                 phash_cache: Optional[PerceptualHashCache] = None,
+                 convert_animated: bool = False,
+                 instrumentation: Optional[Instrumentation] = None,
+                 bandwidth_limiter: Optional[BandwidthLimiter] = None):
         self._executor = executor
-        self._mw = mw
+        # Called with a progress label, from the executor threads. None when
+        # nobody is listening.
+        self._on_progress = on_progress
+        self._image_cache = image_cache
+        # Images whose perceptual hashes are at most this many bits apart are
+        # considered the same. Negative turns the check off.
+        self._near_duplicate_threshold = near_duplicate_threshold
+        self._phash_cache = phash_cache
+        # Whether animated images are converted to the output format too.
+        self._convert_animated = convert_animated
+        self._instrumentation = instrumentation or Instrumentation()
+        # Limits how fast search pages and images are read, if set.
+        self._bandwidth_limiter = bandwidth_limiter
+        self._stats_lock = threading.Lock()
+        self.near_duplicates_skipped = 0
+        # Total size of the images kept, before and after being converted to
+        # the output format.
+        self.bytes_before_conversion = 0
+        self.bytes_after_conversion = 0
+        self._download_limits = download_limits
+        self._domain_scoreboard = domain_scoreboard
+        self._image_processor = image_processor or ImageProcessor()
+        # Called from the executor threads once the image URLs for a query are
+        # known.
+        self._on_searched = on_searched
+        # All requests in a run go through this so connections get reused.
+        self._http = SessionPool(headers=Scraper.SPOOFED_HEADER,
+                                 max_connections_per_host=max_connections_per_host)
+        self._search_cache = search_cache
+        # When bypassing, the cache is still refreshed with the new results, it's
+        # just never read from.
+        self._bypass_cache = bypass_cache
+
+    @property
+    def connection_stats(self):
+        return self._http.stats
+
+    def close(self) -> None:
+        """
+        Closes the pooled connections and the image workers. Call this once the
+        run is done.
+        """
+        self._http.close()
+        self._image_processor.close()
+
+    @staticmethod
+    def _num_urls_to_search(result: QueryResult) -> int:
+        return result.max_results + Scraper.SEARCH_HEADROOM
+
+    def _get_cached_image_urls(self, result: QueryResult) -> Optional[List[str]]:
+        if self._search_cache is None or self._bypass_cache:
+            return None
+        return self._search_cache.get(result.query,
+                                      self._num_urls_to_search(result))
+
+    def _cache_image_urls(self, result: QueryResult,
+                          image_urls: List[str]) -> None:
+        if self._search_cache is not None:
+            self._search_cache.put(result.query, image_urls,
+                                   self._num_urls_to_search(result))
+
+    def _update_progress(self, label: str) -> None:
+        """
+        Updates the progress label. Safe to call from the executor threads, as
+        long as `on_progress` is.
+        """
+        if self._on_progress is not None:
+            self._on_progress(label)
 
     def push_scrape_job(self, result: QueryResult):
         """
@@ -100,136 +256,576 @@ class BingScraper(Scraper):
     SEARCH_FORMAT_URL = "https://www.bing.com/images/async?q={}"
     TIMEOUT_SEC = 15
     MAX_RETRIES = 3
-    # Number of seconds to sleep per retry on rate limit error.
-    THROTTLE_SLEEP_SEC = 30
-    # Number of seconds to sleep per retry on timeout error.
-    TIMEOUT_SLEEP_SEC = 5
+    # Retries back off exponentially (with jitter) from the base up to the cap.
+    BACKOFF_BASE_SEC = 2
+    BACKOFF_CAP_SEC = 60
 
     # Taken from bing-image-downloader
     IMAGE_URL_REGEX = 'murl&quot;:&quot;(.*?)&quot;'
-
-    def __init__(self, executor: concurrent.futures.ThreadPoolExecutor, mw):
-        super().__init__(executor, mw)
+    # The literal text that every match of IMAGE_URL_REGEX starts with.
+    IMAGE_URL_PREFIX = 'murl&quot;:&quot;'
+    SEARCH_CHUNK_BYTES = 16 * 1024
+    # Upper bound on the number of search requests in flight at once. Downloads
+    # aren't limited by this, only by the size of the executor.
+    DEFAULT_SEARCH_CONCURRENCY = 4
+    # Number of threads downloading images, shared by all queries.
+    DOWNLOAD_WORKERS = 32
+    # Number of extra candidate images to download for each query beyond the
+    # number of results needed, to make up for the ones that fail.
+    DOWNLOAD_OVERPROVISION = 2
+    # If none of a query's downloads finish within this long, start one more
+    # candidate, up to MAX_HEDGES times per query.
+    HEDGE_AFTER_SEC = 2
+    MAX_HEDGES = 2
+    DOWNLOAD_CHUNK_BYTES = 64 * 1024
+    # Image downloads bigger than this are spooled to disk instead of memory.
+    SPOOL_IN_MEMORY_BYTES = 1024 * 1024
+    # Stop trying to read the dimensions from the header after this many bytes.
+    SNIFF_MAX_BYTES = 256 * 1024
+    # Starting number of search requests per second. This adapts as Bing starts
+    # (or stops) throttling us.
+    DEFAULT_SEARCH_RATE = 4.0
+
+    def __init__(self, executor: concurrent.futures.ThreadPoolExecutor,
+                 on_progress: Optional[Callable[[str], None]] = None,
+                 search_cache: Optional[SearchCache] = None,
+                 bypass_cache: bool = False,
+                 search_concurrency: int = DEFAULT_SEARCH_CONCURRENCY,
+                 max_connections_per_host: int = SessionPool.DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 search_rate: float = DEFAULT_SEARCH_RATE,
+                 on_searched: Optional[Callable[[QueryResult, List[str]], None]] = None,
+                 domain_scoreboard: Optional[DomainScoreboard] = None,
+                 image_processor: Optional[ImageProcessor] = None,
+                 download_limits: DownloadLimits = DownloadLimits(),
+                 image_cache: Optional[ImageCache] = None,
+                 near_duplicate_threshold: int = -1,
+                 phash_cache: Optional[PerceptualHashCache] = None,
+                 convert_animated: bool = False,
+                 instrumentation: Optional[Instrumentation] = None,
+                 bandwidth_limiter: Optional[BandwidthLimiter] = None):
+        super().__init__(executor, on_progress, search_cache, bypass_cache,
+                         max_connections_per_host, on_searched,
+                         domain_scoreboard, image_processor, download_limits,
+                         image_cache, near_duplicate_threshold, phash_cache,
+                         convert_animated, instrumentation,
+                         bandwidth_limiter)
+        # Separate from `executor`, since the jobs on `executor` block on the
+        # downloads.
+        self._download_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=BingScraper.DOWNLOAD_WORKERS)
+        self._instrumentation.set_pool_size("download workers",
+                                            BingScraper.DOWNLOAD_WORKERS)
+        # Shared by every search job, so that a 429 slows all of them down.
+        self._rate_limiter = AdaptiveRateLimiter(
+            rate=search_rate, max_concurrency=search_concurrency)
+
+    def close(self) -> None:
+        # Stragglers from overprovisioning and hedging already had their
+        # query's `cancelled` set, so they stop at their next chunk. Wait for
+        # them anyway, they still record into the stores and the image cache,
+        # which get closed after this.
+        self._download_executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
 
     def push_scrape_job(self, result: QueryResult):
         """
-        Fire off a request to the image search page, then queue up a job to scrape
-        the images from the resulting text and resize them.
+        Queue up a job that requests the image search page, then scrapes the
+        images from the resulting text and resizes them.
+
+        Both the search and the downloads run on the executor, so the search
+        round trips for different queries overlap. At most `search_concurrency`
+        searches are in flight at once.
         """
-        # Note that the REQUEST is not
-        # multithreaded, but parsing/extracting images is (disputable whether this
-        # is the correct architecture, but I'm just going to copy this guy's code).
-        # In case of a status exception, retry
-        search_url = BingScraper.SEARCH_FORMAT_URL.format(result.query)
-        retry_count = 0
-        while retry_count < BingScraper.MAX_RETRIES:
-            try:
-                req = requests.get(search_url, headers=Scraper.SPOOFED_HEADER,
-                                   timeout=BingScraper.TIMEOUT_SEC)
-                req.raise_for_status()
-                future = self._executor.submit(
-                    self._parse_and_download_images, req.text, result)
-                return future
-            except requests.exceptions.RequestException as e:
-                logger.exception(e)
-                if retry_count == BingScraper.MAX_RETRIES:
-                    raise Exception(
-                        "Exceeded max retries. Unable to scrape for query: %s" %
-                        result.query)
-                retry_count += 1
-
-                if isinstance(
-                        e, requests.exceptions.HTTPError) and e.response.status_code == 429:
-                    # Retry on 429: we were rate limited
-                    self._mw.progress.update(
-                        f"Sleeping for {retry_cnt * 30} seconds...")
-                    QApplication.instance().processEvents()
-                    sleep(retry_cnt * BingScraper.THROTTLE_SLEEP_SEC)
-                elif isinstance(e, (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError)):
-                    # Connection error
-                    self._mw.progress.update(
-                        f"Sleeping for {retry_cnt * 5} seconds...")
-                    QApplication.instance().processEvents()
-                    sleep(retry_cnt * BingScraper.TIMEOUT_SLEEP_SEC)
-                else:
-                    raise e
+        return self._executor.submit(self._scrape, result)
 
-    def _parse_and_download_images(
-            self,
-            html: str,
-            result: QueryResult) -> QueryResult:
+    def prefetch(self, result: QueryResult,
+                 cancelled: threading.Event) -> bool:
         """
-        Parses the image URLs out of the HTML. Processes and resizes them.
+        Warms the caches for `result` without changing it: the image URLs go
+        into the search cache, and the original images that a scrape would
+        most likely use go into the image cache. Runs on the calling thread,
+        one download at a time.
 
-        This function **mutates** `result` and also returns it.
+        Returns False if it was cancelled before it was done.
         """
-        # Check README for why this import is here.
-        from PIL import UnidentifiedImageError
-        image_urls = re.findall(BingScraper.IMAGE_URL_REGEX, html)
-        num_processed = 0
-        if len(image_urls) == 0:
-            logger.debug("Found 0 image URLs for query: %s" % result.query)
-
-        for url in image_urls:
-            if num_processed == result.max_results:
+        image_urls = self._get_cached_image_urls(result)
+        if image_urls is None:
+            image_urls = list(self._search(
+                result.query, self._num_urls_to_search(result), cancelled))
+            # Don't cache what's only part of the results.
+            if cancelled.is_set():
+                return False
+            self._cache_image_urls(result, image_urls)
+        if self._image_cache is None:
+            return True
+        if self._domain_scoreboard is not None:
+            image_urls = self._domain_scoreboard.rank(image_urls)
+
+        num_cached = 0
+        num_candidates = result.max_results + BingScraper.DOWNLOAD_OVERPROVISION
+        for url in image_urls[:num_candidates]:
+            if num_cached == result.max_results or cancelled.is_set():
                 break
-
-            try:
-                req = requests.get(url,
-                                   headers=Scraper.SPOOFED_HEADER,
-                                   timeout=BingScraper.TIMEOUT_SEC)
-                req.raise_for_status()
-            except requests.packages.urllib3.exceptions.LocationParseError:
-                continue
-            except requests.exceptions.RequestException:
+            original, _ = self._open_original_image(url, cancelled)
+            if original is None:
                 continue
+            body, cache_headers = original
+            with body:
+                # Headers are None if it was already in the cache.
+                if cache_headers is not None:
+                    # Only cache what turns out to be an image, like
+                    # `_fetch_image` does.
+                    if not self._is_image(body):
+                        continue
+                    self._image_cache.store(url, body, *cache_headers)
+            num_cached += 1
+        return not cancelled.is_set()
+
+    @staticmethod
+    def _is_image(body: BinaryIO) -> bool:
+        """
+        Checks that `body` is an image Pillow can read, without decoding all
+        of it. Rewinds `body` afterwards.
+        """
+        # Check README for why this import is here.
+        from PIL import Image
+        try:
+            body.seek(0)
+            with Image.open(body) as im:
+                im.verify()
+            return True
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return False
+        finally:
+            body.seek(0)
+
+    def _scrape(self, result: QueryResult) -> QueryResult:
+        with self._instrumentation.span("query", pool="query workers"):
+            return self._scrape_query(result)
+
+    def _scrape_query(self, result: QueryResult) -> QueryResult:
+        """
+        Runs on the executor. Searches for the query (unless the URLs are
+        already known or the search is cached), then downloads the images.
 
-            # Ignore SVGs. Dunno, the last guy did it too, maybe they won't work
-            # with Anki.
-            if 'image/svg+xml' in req.headers.get('content-type', ''):
-                continue
+        A search is streamed straight into the downloads, so the first images
+        start downloading while the rest of the results page is still coming
+        in.
+
+        This function **mutates** `result` and also returns it.
+        """
+        image_urls = result.image_urls
+        if image_urls is None:
+            image_urls = self._get_cached_image_urls(result)
+        if image_urls is not None:
+            if self._on_searched is not None:
+                self._on_searched(result, image_urls)
+            return self._download_images(image_urls, result)
+
+        def search_and_record():
+            found_urls = []
+            for url in self._search(result.query,
+                                    self._num_urls_to_search(result)):
+                found_urls.append(url)
+                yield url
+            # Runs as soon as the search is done, which is while the first
+            # downloads are still going, so the URLs are journaled even if the
+            # downloads never finish.
+            if len(found_urls) == 0:
+                logger.debug("Found 0 image URLs for query: %s" % result.query)
+            self._cache_image_urls(result, found_urls)
+            if self._on_searched is not None:
+                self._on_searched(result, found_urls)
+
+        return self._download_images(search_and_record(), result)
+
+    def _search(self, query: str, max_urls: int,
+                cancelled: Optional[threading.Event] = None) -> Iterator[str]:
+        """
+        Fire off a request to the image search page and parse the image URLs out
+        of the HTML as it arrives.
 
+        This is a generator: URLs are yielded as soon as they're found, and the
+        request is dropped once `max_urls` URLs have been found, or as soon as
+        `cancelled` is set.
+        """
+        search_url = BingScraper.SEARCH_FORMAT_URL.format(query)
+        for attempt in range(BingScraper.MAX_RETRIES + 1):
+            if cancelled is not None and cancelled.is_set():
+                return
+            retry_after = None
+            num_found = 0
+            if not self._rate_limiter.acquire(cancelled):
+                return
+            start = time.perf_counter()
+            num_bytes = 0
             try:
-                buf = _maybe_resize_image(req.content, result.width,
-                                          result.height)
-            except UnidentifiedImageError:
-                continue
-            except UnicodeError as e:
-                # UnicodeError: encoding with 'idna' codec failed (UnicodeError: label empty or too long)
-                # https://bugs.python.org/issue32958
-                continue
+                with self._http.get(search_url,
+                                    timeout=BingScraper.TIMEOUT_SEC,
+                                    stream=True) as req:
+                    req.raise_for_status()
+                    self._rate_limiter.on_success()
+                    extractor = UrlExtractor(BingScraper.IMAGE_URL_REGEX,
+                                             BingScraper.IMAGE_URL_PREFIX)
+                    for chunk in req.iter_content(BingScraper.SEARCH_CHUNK_BYTES):
+                        if cancelled is not None and cancelled.is_set():
+                            return
+                        num_bytes += len(chunk)
+                        if self._bandwidth_limiter is not None:
+                            self._bandwidth_limiter.consume(len(chunk))
+                        with self._instrumentation.span("url_extraction"):
+                            urls = extractor.feed(chunk)
+                        for url in urls:
+                            yield url
+                            num_found += 1
+                            if num_found == max_urls:
+                                return
+                    return
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code != 429:
+                    raise e
+                # We were rate limited. This also holds back every other job
+                # until Retry-After has passed.
+                logger.debug("Rate limited on query: %s" % query)
+                retry_after = parse_retry_after(
+                    e.response.headers.get("Retry-After"))
+                self._rate_limiter.on_throttle(retry_after)
+            except (requests.exceptions.ReadTimeout,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                logger.exception(e)
+                # The URLs that were already yielded are in use, so retrying
+                # would yield them twice. Make do with what we got.
+                if num_found > 0:
+                    return
+                self._rate_limiter.on_throttle()
+            finally:
+                self._rate_limiter.release()
+                # This includes the time the URLs spent being handed out.
+                self._instrumentation.record("search", start, num_bytes)
+
+            if attempt == BingScraper.MAX_RETRIES:
+                break
+            # This runs on a worker thread, so just block the thread.
+            delay = max(retry_after or 0,
+                        backoff_delay(attempt, BingScraper.BACKOFF_BASE_SEC,
+                                      BingScraper.BACKOFF_CAP_SEC))
+            self._update_progress(
+                "Throttled by Bing, retrying in %d seconds..." % delay)
+            if cancelled is None:
+                time.sleep(delay)
+            elif cancelled.wait(delay):
+                return
+        raise Exception(
+            "Exceeded max retries. Unable to scrape for query: %s" % query)
+
+    def _download_images(
+            self,
+            image_urls: Iterable[str],
+            result: QueryResult) -> QueryResult:
+        """
+        Downloads and resizes images from the URLs until `result.max_results` of
+        them succeed.
+
+        Candidates are downloaded in parallel: the top `max_results` plus
+        `DOWNLOAD_OVERPROVISION` extra ones start at once, and every failure
+        starts the next candidate. If nothing finishes for `HEDGE_AFTER_SEC`,
+        another candidate is started in case the ones in flight are stuck on
+        a slow host. Once there are enough successes, the rest are cancelled.
+        The images are kept in the order that the search returned them.
+
+        `image_urls` can be a generator (see `_search`). The first candidates
+        start downloading as soon as they're yielded, and the rest are read
+        while those downloads are running.
+
+        If there is a domain scoreboard, candidates on hosts that have been
+        failing are skipped, and tried last when the whole list is known up
+        front.
 
-            filename = checksum(url + result.query)
-            result.images.append((filename, buf.getvalue()))
-            num_processed += 1
+        If near-duplicate filtering is on, images that look the same as one
+        that was already accepted for this query are thrown away, and the next
+        candidate is tried in their place.
 
+        This function **mutates** `result` and also returns it.
+        """
+        if self._domain_scoreboard is not None:
+            if isinstance(image_urls, list):
+                image_urls = self._domain_scoreboard.rank(image_urls)
+            else:
+                image_urls = self._domain_scoreboard.skip_failing(image_urls)
+        candidates = iter(enumerate(image_urls))
+        # rank -> (filename, image data, size before conversion)
+        accepted = {}
+        # Perceptual hashes of the accepted images.
+        accepted_hashes = []
+        # future -> (rank, url)
+        in_flight = {}
+        cancelled = threading.Event()
+        num_hedges = 0
+
+        def launch_next_candidate() -> None:
+            candidate = next(candidates, None)
+            if candidate is None:
+                return
+            rank, url = candidate
+            future = self._download_executor.submit(
+                self._download_image, url, result, cancelled)
+            in_flight[future] = (rank, url)
+            self._instrumentation.sample("downloads in flight per query",
+                                         len(in_flight))
+
+        try:
+            for _ in range(result.max_results + BingScraper.DOWNLOAD_OVERPROVISION):
+                launch_next_candidate()
+            # With a streamed search, this reads the rest of the candidates (and
+            # so finishes the search request) while the first downloads are
+            # running.
+            candidates = iter(list(candidates))
+
+            while in_flight and len(accepted) < result.max_results:
+                done, _ = concurrent.futures.wait(
+                    in_flight, timeout=BingScraper.HEDGE_AFTER_SEC,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    if num_hedges < BingScraper.MAX_HEDGES:
+                        num_hedges += 1
+                        launch_next_candidate()
+                    continue
+                for future in done:
+                    rank, url = in_flight.pop(future)
+                    try:
+                        image = future.result()
+                    except Exception as e:
+                        # One broken candidate shouldn't fail the query, or
+                        # else it fails the same way on every resume.
+                        logger.exception(e)
+                        image = None
+                    if image is None or self._is_near_duplicate(
+                            url, image[1], accepted_hashes, result):
+                        launch_next_candidate()
+                    else:
+                        accepted[rank] = image
+        finally:
+            # Stragglers will see this and stop at their next chunk.
+            cancelled.set()
+            for future in in_flight:
+                future.cancel()
+
+        for rank in sorted(accepted)[:result.max_results]:
+            filename, data, size_before_conversion = accepted[rank]
+            result.images.append((filename, data))
+            with self._stats_lock:
+                self.bytes_before_conversion += size_before_conversion
+                self.bytes_after_conversion += len(data)
         return result
 
+    def _is_near_duplicate(self, url: str, data: bytes,
+                           accepted_hashes: List[int],
+                           result: QueryResult) -> bool:
+        """
+        Checks whether the image looks like one of the already accepted ones.
+        If it doesn't, its hash is added to `accepted_hashes`.
+        """
+        # With one result there's never anything to compare against.
+        if self._near_duplicate_threshold < 0 or result.max_results <= 1:
+            return False
+        image_hash = None
+        if self._phash_cache is not None:
+            image_hash = self._phash_cache.get(url)
+        if image_hash is None:
+            image_hash = dhash(data)
+            if image_hash is None:
+                return False
+            if self._phash_cache is not None:
+                self._phash_cache.put(url, image_hash)
+
+        for other in accepted_hashes:
+            if hamming_distance(image_hash, other) <= self._near_duplicate_threshold:
+                with self._stats_lock:
+                    self.near_duplicates_skipped += 1
+                return True
+        accepted_hashes.append(image_hash)
+        return False
+
+    def _download_image(
+            self,
+            url: str,
+            result: QueryResult,
+            cancelled: threading.Event) -> Optional[Tuple[str, bytes, int]]:
+        """
+        Runs on the download executor. Downloads, resizes and converts a single
+        image.
+
+        Returns (filename, image data, size before conversion), or None if the
+        image couldn't be used.
+        """
+        if cancelled.is_set():
+            return None
+        if (self._domain_scoreboard is not None
+                and not self._domain_scoreboard.claim(url)):
+            return None
+        start = time.monotonic()
+        with self._instrumentation.span("image", pool="download workers"):
+            image, outcome = self._fetch_image(url, result, cancelled)
+        latency = time.monotonic() - start
+        # A cancelled download says nothing about the host.
+        if self._domain_scoreboard is not None and not cancelled.is_set():
+            if outcome == HostOutcome.FAILED:
+                self._domain_scoreboard.record_failure(url, latency)
+            elif outcome == HostOutcome.OK and image is not None:
+                self._domain_scoreboard.record_success(url, latency,
+                                                       len(image[1]))
+        return image
+
+    def _fetch_image(
+            self,
+            url: str,
+            result: QueryResult,
+            cancelled: threading.Event
+    ) -> Tuple[Optional[Tuple[str, bytes, int]], str]:
+        """
+        Returns (the image as `_download_image` does, HostOutcome).
+        """
+        # Check README for why this import is here.
+        from PIL import Image
+
+        with self._instrumentation.span("image_download"):
+            original, outcome = self._open_original_image(url, cancelled)
+        if original is None:
+            return None, outcome
+        body, cache_headers = original
 
-def _maybe_resize_image(
-        img_data: io.BytesIO,
-        user_width: int,
-        user_height: int) -> io.BytesIO:
-    # Check README for why this import is here.
-    from PIL import Image
-
-    should_resize = user_width > 0 or user_height > 0
-
-    # GIFs can't be resized, again according to the last dude, I'll take
-    # his word for it.
-    img_io = io.BytesIO(img_data)
-    im = Image.open(img_io)
-    is_gif = getattr(im, 'n_frames', 1) != 1
-    if not should_resize or is_gif:
-        return img_io
-
-    old_width, old_height = im.width, im.height
-    new_width, new_height = old_width, old_height
-    if user_width > 0:
-        new_width = min(new_width, user_width)
-    if user_height > 0:
-        new_height = min(new_height, user_height)
-    im.thumbnail((new_width, new_height))
-    buf = io.BytesIO()
-    im.save(buf, format=im.format, optimize=True)
-    return buf
+        with body:
+            try:
+                with self._instrumentation.span("image_processing") as span:
+                    data, size_before_conversion = self._image_processor.process(
+                        body, result.width, result.height, result.output_format,
+                        result.quality, self._convert_animated)
+                    span.num_bytes = len(data)
+            # OSError includes UnidentifiedImageError and truncated images,
+            # and Pillow raises ValueError for some broken headers.
+            except (OSError, ValueError, Image.DecompressionBombError):
+                return None, HostOutcome.NONE
+            # Only cache what turned out to be an image.
+            if cache_headers is not None and self._image_cache is not None:
+                self._image_cache.store(url, body, *cache_headers)
+
+        filename = checksum(url + result.query)
+        return (filename, data, size_before_conversion), outcome
+
+    def _open_original_image(
+            self,
+            url: str,
+            cancelled: threading.Event
+    ) -> Tuple[Optional[Tuple[BinaryIO, Optional[Tuple]]], str]:
+        """
+        Gets the original image, from the image cache if it's there and still
+        fresh, and otherwise from the network (revalidating the cached copy
+        if there is one).
+
+        Returns ((file with the image, (ETag, Last-Modified)), HostOutcome),
+        where the headers are None if the image didn't need to be downloaded.
+        The first element is None if the image couldn't be gotten.
+        """
+        cached = None
+        if self._image_cache is not None:
+            cached = self._image_cache.lookup(url)
+        if cached is not None and cached.fresh:
+            body = self._image_cache.open(cached)
+            if body is not None:
+                return (body, None), HostOutcome.NONE
+            cached = None
+
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        try:
+            with self._http.get(url, timeout=BingScraper.TIMEOUT_SEC,
+                                stream=True, headers=headers) as req:
+                if req.status_code == 304 and cached is not None:
+                    self._image_cache.mark_validated(url)
+                    body = self._image_cache.open(cached)
+                    if body is None:
+                        return None, HostOutcome.NONE
+                    # Says nothing about how long the host takes to send an
+                    # image.
+                    return (body, None), HostOutcome.NONE
+                req.raise_for_status()
+                content_type = req.headers.get('content-type', '')
+                # Ignore SVGs. Dunno, the last guy did it too, maybe they won't
+                # work with Anki. HTML (e.g. a login page) is never an image.
+                if 'image/svg+xml' in content_type or content_type.startswith('text/'):
+                    return None, HostOutcome.NONE
+                body = self._read_image_body(req, cancelled)
+                cache_headers = (req.headers.get('etag'),
+                                 req.headers.get('last-modified'))
+        except requests.packages.urllib3.exceptions.LocationParseError:
+            return None, HostOutcome.NONE
+        except requests.exceptions.RequestException:
+            # Including HTTP errors and timeouts, also in the middle of the
+            # body.
+            return None, HostOutcome.FAILED
+        except UnicodeError:
+            # UnicodeError: encoding with 'idna' codec failed (UnicodeError: label empty or too long)
+            # https://bugs.python.org/issue32958
+            return None, HostOutcome.NONE
+        if body is None:
+            # Over the limits (or cancelled).
+            return None, HostOutcome.NONE
+        return (body, cache_headers), HostOutcome.OK
+
+    def _read_image_body(
+            self,
+            req: requests.Response,
+            cancelled: threading.Event) -> Optional[BinaryIO]:
+        """
+        Reads the body of an image response in chunks into a temporary file
+        (which stays in memory while it's small).
+
+        Gives up and returns None as soon as the download is cancelled, it goes
+        over the byte limit, or the dimensions in the image header are outside
+        of the pixel limits.
+        """
+        limits = self._download_limits
+        content_length = req.headers.get('content-length', '')
+        if content_length.isdigit() and int(content_length) > limits.max_bytes:
+            return None
+
+        body = tempfile.SpooledTemporaryFile(
+            max_size=BingScraper.SPOOL_IN_MEMORY_BYTES)
+        # The start of the body, until the dimensions can be read from it.
+        header = b""
+        sniffing = True
+        num_bytes = 0
+        for chunk in req.iter_content(BingScraper.DOWNLOAD_CHUNK_BYTES):
+            num_bytes += len(chunk)
+            if self._bandwidth_limiter is not None:
+                self._bandwidth_limiter.consume(len(chunk))
+            if cancelled.is_set() or num_bytes > limits.max_bytes:
+                body.close()
+                return None
+            body.write(chunk)
+
+            if sniffing:
+                header += chunk
+                size = sniff_image_size(header)
+                if size is not None:
+                    sniffing = False
+                    num_pixels = size[0] * size[1]
+                    if not limits.min_pixels <= num_pixels <= limits.max_pixels:
+                        body.close()
+                        return None
+                elif len(header) >= BingScraper.SNIFF_MAX_BYTES:
+                    # Couldn't tell from the header. Download the whole thing
+                    # and let the resize step decide.
+                    sniffing = False
+                if not sniffing:
+                    header = b""
+
+        self._instrumentation.add_bytes("image_download", num_bytes)
+        body.seek(0)
+        return body
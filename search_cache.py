@@ -0,0 +1,104 @@
+"""
+A persistent cache of search query -> image URLs, so that re-running a batch
+doesn't have to hit the search engine again.
+"""
+import json
+import time
+from typing import List, Optional
+from .store import SqliteStore
+
+
+class SearchCache(SqliteStore):
+    """
+    Maps a search query to the image URLs that were extracted from its results
+    page. Searches stop reading the page once they have enough URLs, so every
+    entry also has how many URLs it was searched for, and it's only used for
+    queries that don't need more than that.
+
+    Entries expire after `ttl_sec` seconds. Once there are more than
+    `max_entries` entries, the least recently used ones are evicted.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS searches (
+        query TEXT PRIMARY KEY,
+        urls TEXT NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL,
+        searched_for INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS searches_accessed ON searches (accessed);
+    """
+
+    def __init__(self, path: str, ttl_sec: float, max_entries: int):
+        super().__init__(path)
+        with self._lock:
+            columns = [row[1] for row in self._conn.execute(
+                "PRAGMA table_info(searches)")]
+            # Caches from before searches were cut short. Their entries count
+            # as searched for 0 URLs, so they're searched again once.
+            if "searched_for" not in columns:
+                self._conn.execute(
+                    "ALTER TABLE searches ADD COLUMN "
+                    "searched_for INTEGER NOT NULL DEFAULT 0")
+                self._conn.commit()
+        self._ttl_sec = ttl_sec
+        self._max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query: str, max_urls: int) -> Optional[List[str]]:
+        """
+        Returns the cached URLs for the query, or None on a miss. An entry that
+        was searched for fewer than `max_urls` URLs is a miss.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT urls, created, searched_for FROM searches "
+                "WHERE query = ?",
+                (query,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            urls, created, searched_for = row
+            if searched_for < max_urls:
+                # Left for `put` to replace.
+                self.misses += 1
+                return None
+            if now - created > self._ttl_sec:
+                self._conn.execute(
+                    "DELETE FROM searches WHERE query = ?", (query,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE searches SET accessed = ? WHERE query = ?",
+                (now, query))
+            self._conn.commit()
+            self.hits += 1
+            return json.loads(urls)
+
+    def put(self, query: str, urls: List[str], searched_for: int) -> None:
+        """
+        Caches the URLs for the query, which were searched for up to
+        `searched_for` of them. Evicts the least recently used entries if the
+        cache is over its size limit.
+        """
+        # An empty result is more likely to be a hiccup (or a change in the
+        # results page) than a real answer, so don't remember it.
+        if not urls:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO searches (query, urls, created, "
+                "accessed, searched_for) VALUES (?, ?, ?, ?, ?)",
+                (query, json.dumps(urls), now, now, searched_for))
+            self._conn.execute(
+                "DELETE FROM searches WHERE query IN ("
+                "SELECT query FROM searches ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self._max_entries,))
+            self._conn.commit()
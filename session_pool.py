@@ -0,0 +1,111 @@
+"""
+A shared, pooled HTTP session so that connections (and their TCP/TLS handshakes)
+are reused across all of the jobs in a run.
+"""
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class ConnectionStats:
+    """
+    Counters for how well the connection pool is doing. Updated from many
+    threads at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        # Total time spent in connect(), i.e. DNS + TCP + TLS handshakes.
+        self.handshake_sec = 0.0
+
+    @property
+    def connections_reused(self) -> int:
+        return max(0, self.requests - self.connections_opened)
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_connect(self, seconds: float) -> None:
+        with self._lock:
+            self.connections_opened += 1
+            self.handshake_sec += seconds
+
+
+def _make_pool_class(pool_cls, connection_cls, stats: ConnectionStats):
+    """
+    Makes a urllib3 pool class whose connections report their handshakes to
+    `stats`.
+    """
+    class TimedConnection(connection_cls):
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            stats.record_connect(time.perf_counter() - start)
+
+    return type("Timed" + pool_cls.__name__, (pool_cls,),
+                {"ConnectionCls": TimedConnection})
+
+
+class _PooledAdapter(HTTPAdapter):
+    def __init__(self, stats: ConnectionStats, max_hosts: int,
+                 max_connections_per_host: int):
+        # Needs to be set before super().__init__, which calls
+        # init_poolmanager.
+        self._stats = stats
+        # pool_block makes requests wait for a free connection to the host
+        # instead of opening (and then throwing away) extra ones, which is what
+        # enforces the per-host limit.
+        super().__init__(pool_connections=max_hosts,
+                         pool_maxsize=max_connections_per_host,
+                         pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _make_pool_class(HTTPConnectionPool, HTTPConnection,
+                                     self._stats),
+            "https": _make_pool_class(HTTPSConnectionPool, HTTPSConnection,
+                                      self._stats),
+        }
+
+    def send(self, request, *args, **kwargs):
+        self._stats.record_request()
+        return super().send(request, *args, **kwargs)
+
+
+class SessionPool:
+    """
+    Wraps a `requests.Session` with keep-alive connection pools for each host,
+    capped at `max_connections_per_host` connections per host.
+
+    Note that neither requests nor urllib3 speak HTTP/2, so this is HTTP/1.1
+    only.
+    """
+    # How many hosts to keep connection pools around for. Image results are
+    # spread over a lot of hosts, but the popular ones repeat.
+    DEFAULT_MAX_HOSTS = 64
+    DEFAULT_MAX_CONNECTIONS_PER_HOST = 6
+
+    def __init__(self, headers=None,
+                 max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 max_hosts: int = DEFAULT_MAX_HOSTS):
+        self.stats = ConnectionStats()
+        self._session = requests.Session()
+        if headers:
+            self._session.headers.update(headers)
+        adapter = _PooledAdapter(self.stats, max_hosts,
+                                 max(1, max_connections_per_host))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self._session.get(url, **kwargs)
+
+    def close(self) -> None:
+        self._session.close()
@@ -0,0 +1,47 @@
+"""
+Shared plumbing for the small SQLite databases the add-on keeps on disk.
+"""
+import os
+import sqlite3
+import threading
+
+# Anki keeps the user_files folder around when an add-on is updated, so anything
+# that should survive an update lives in there.
+USER_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "user_files")
+
+
+def user_files_path(*parts: str) -> str:
+    """
+    Returns a path inside of the add-on's user_files folder, creating the folder
+    if needed.
+    """
+    path = os.path.join(USER_FILES_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class SqliteStore:
+    """
+    A SQLite database that can be shared between the executor threads.
+
+    Subclasses provide the `SCHEMA`, which is run every time the database is
+    opened, so it should only contain `IF NOT EXISTS` statements.
+    """
+    SCHEMA = ""
+
+    def __init__(self, path: str):
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps readers from blocking on writers and makes commits cheaper,
+        # which matters since most stores are written to from many threads.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(self.SCHEMA)
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
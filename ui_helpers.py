@@ -1,30 +1,5 @@
 from aqt.qt import *
-
-
-class OverwriteValues:
-    """
-    Possible values for the overwrite config.
-    """
-    OVERWRITE = "Overwrite"
-    SKIP = "Skip"
-    APPEND = "Append"
-
-
-class ConfigKeys:
-    """
-    See config.json
-    """
-    SOURCE_FIELD = "sourceField"
-    DELIMITER = "delimiter"
-    LABEL = "label"
-    QUERY_CONFIGS = "queryConfigs"
-    SEARCH_TERM = "searchTerm"
-    TARGET_FIELD = "targetField"
-    RESULT_COUNT = "resultCount"
-    WIDTH = "width"
-    HEIGHT = "height"
-    OVERWRITE = "overwrite"
-
+from .config_keys import ConfigDefaults, ConfigKeys, OutputFormatValues, OverwriteValues
 
 # The order in which the keys appear as columns in the query config form.
 #
@@ -39,17 +14,9 @@ QUERY_CONFIG_KEY_ORDER = (
     ConfigKeys.RESULT_COUNT,
     ConfigKeys.OVERWRITE,
     ConfigKeys.WIDTH,
-    ConfigKeys.HEIGHT)
-
-
-class ConfigDefaults:
-    RESULT_COUNT = 1
-    WIDTH = -1
-    HEIGHT = -1
-    OVERWRITE = "Skip"
-    IGNORED = "<ignored>"
-    # The placeholder value in the search term the user provides.
-    WORD_PLACEHOLDER = "{}"
+    ConfigKeys.HEIGHT,
+    ConfigKeys.OUTPUT_FORMAT,
+    ConfigKeys.QUALITY)
 
 
 COLUMN_LABELS = [
@@ -59,7 +26,9 @@ COLUMN_LABELS = [
     "Result Count",
     "If not empty?",
     "",
-    ""]
+    "",
+    "Format",
+    "Quality"]
 
 
 def make_target_field_select(options, config_value) -> QComboBox:
@@ -88,6 +57,26 @@ def make_result_count_box(config_value) -> QSpinBox:
     return spinBox
 
 
+def make_output_format_select(config_value) -> QComboBox:
+    select = QComboBox()
+    select.setObjectName(ConfigKeys.OUTPUT_FORMAT)
+    select.addItem(OutputFormatValues.ORIGINAL)
+    select.addItem(OutputFormatValues.WEBP)
+    select.addItem(OutputFormatValues.AVIF)
+    select.setCurrentIndex(max(0, select.findText(config_value)))
+    return select
+
+
+def make_quality_box(config_value) -> QSpinBox:
+    spinBox = QSpinBox()
+    spinBox.setObjectName(ConfigKeys.QUALITY)
+    spinBox.setMinimum(1)
+    spinBox.setMaximum(100)
+    spinBox.setValue(config_value)
+    spinBox.setToolTip("Only used when the format isn't Original")
+    return spinBox
+
+
 def make_overwrite_select(config_value) -> QComboBox:
     select = QComboBox()
     select.setObjectName(ConfigKeys.OVERWRITE)
@@ -116,14 +105,16 @@ def make_dimension_spin_box(config_value, label) -> QHBoxLayout:
     return hbox
 
 
-def serialize_config_from_ui(form):
+def serialize_config_from_ui(form, old_config):
     """
     Reads/scrapes the form to get the values of the form as a config so that it
     can be saved to disk and persist across uses.
 
     See config.json for the default config.
+
+    Keys that aren't shown in the form are carried over from `old_config`.
     """
-    config = {}
+    config = dict(old_config)
     source_field = form.sourceField.currentText()
     config[ConfigKeys.SOURCE_FIELD] = source_field
 